@@ -19,8 +19,26 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from __future__ import absolute_import
 
-from six import string_types, text_type, binary_type, integer_types
+import io
+import os
+import re
+import sys
+import mmap
+import base64
+import hashlib
+import binascii
+import itertools
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+from six import PY2, add_metaclass, string_types, text_type, binary_type, integer_types
+from six.moves import intern  # pylint: disable=redefined-builtin
 
 
 class BencodeError(ValueError):
@@ -28,82 +46,532 @@ class BencodeError(ValueError):
     """
 
 
+class LazyString(object):
+    """ A string value that is only copied and decoded when accessed.
+
+        Keeps a zero-copy view into the decoded buffer; use C{view} to hash
+        or write the data without ever materializing it.
+    """
+    __slots__ = ('view', 'char_encoding', '_value')
+
+    def __init__(self, view, char_encoding='utf-8'):
+        self.view = view
+        self.char_encoding = char_encoding
+        self._value = None
+
+    def __len__(self):
+        return len(self.view)
+
+    def __bytes__(self):
+        return self.view.tobytes()
+
+    tobytes = __bytes__
+
+    @property
+    def value(self):
+        """ The materialized value, decoded like L{Decoder} does it.
+        """
+        if self._value is None:
+            self._value = self.view.tobytes()
+            if self.char_encoding:
+                try:
+                    self._value = self._value.decode(self.char_encoding)
+                except UnicodeError:
+                    # deliver non-decodable string (byte arrays) as-is
+                    pass
+        return self._value
+
+    def __eq__(self, other):
+        if isinstance(other, LazyString):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return "LazyString(<%d bytes>)" % len(self.view)
+
+    def __bencode__(self):
+        return self.view
+
+
+class _BufferView(object):
+    """ Make a memoryview searchable and sliceable to bytes, like a C{mmap}.
+    """
+    _PATTERNS = {b':': re.compile(b':'), b'e': re.compile(b'e')}
+
+    def __init__(self, view):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.view[index].tobytes()
+        return self.view[index]
+
+    def find(self, sub, start=0):
+        "Find first index of C{sub}, or -1."
+        match = self._PATTERNS[sub].search(self.view, start)
+        return match.start() if match else -1
+
+
+if PY2:
+    def _parse_int(data, base):
+        "Convert a byte string to an int (Python 2 int() rejects a bytearray)."
+        return int(bytes(data), base)
+else:
+    _parse_int = int
+
+
+def _string_pattern(prefix, digits):
+    """ Return a regex matching a string whose length starts with C{prefix},
+        as a tree of alternatives branching on each length digit.
+    """
+    alternatives = [':.{%d}' % int(prefix)] if prefix else []
+    if len(prefix) < digits and prefix != '0':
+        alternatives.extend(digit + _string_pattern(prefix + digit, digits) for digit in '0123456789')
+    return alternatives[0] if len(alternatives) == 1 else '(?:%s)' % '|'.join(alternatives)
+
+
+_SKIP_PATTERNS = {}
+_INTEGER_MATCH = re.compile(b'i(-?[0-9]+)e').match
+
+
+def _skip_patterns(depth=6, digits=2):
+    """ Return regex sources for a string, and for one complete value.
+
+        They only match integers, strings shorter than C{10**digits} bytes,
+        and containers nested up to C{depth} levels, so that large
+        parts of typical data are skipped by the regex engine, and
+        only the rest (e.g. C{pieces}) token by token. Repeats are
+        possessive where supported (Python 3.11+), which saves the
+        engine from keeping backtracking state for each token.
+    """
+    if not _SKIP_PATTERNS:
+        repeat = '*+' if sys.version_info >= (3, 11) else '*'
+        string = _string_pattern('', digits)
+        scalar = 'i-?[0-9]+e|' + string
+        value = '(?:%s)' % scalar
+        for _ in range(depth):
+            value = '(?:%s|[ld]%s%se)' % (scalar, value, repeat)
+        _SKIP_PATTERNS.update(repeat=repeat, string=string, value=value)
+    return _SKIP_PATTERNS
+
+
+def _skip_regexes():
+    """ Return compiled regex C{match} methods for one complete value, and for a run of values.
+    """
+    patterns = _skip_patterns()
+    if 'match' not in patterns:
+        patterns['match'] = (
+            re.compile(patterns['value'].encode('ascii'), re.DOTALL).match,
+            re.compile((patterns['value'] + patterns['repeat']).encode('ascii'), re.DOTALL).match,
+        )
+    return patterns['match']
+
+
+_PAIR_SKIPPERS = {}
+
+
+def _pair_skipper(raw_keys):
+    """ Return a regex C{match} method for a run of dict items whose key is not in C{raw_keys}.
+    """
+    raw_keys = frozenset(raw_keys)
+    try:
+        return _PAIR_SKIPPERS[raw_keys]
+    except KeyError:
+        patterns = _skip_patterns()
+        selected = b'|'.join(re.escape(b'%d:' % len(i) + i) for i in sorted(raw_keys))
+        regex = b'(?:%s%s%s)%s' % (
+            b'(?!%s)' % selected if raw_keys else b'',
+            patterns['string'].encode('ascii'), patterns['value'].encode('ascii'),
+            patterns['repeat'].encode('ascii'),
+        )
+        if len(_PAIR_SKIPPERS) >= 100:
+            _PAIR_SKIPPERS.clear()
+        _PAIR_SKIPPERS[raw_keys] = result = re.compile(regex, re.DOTALL).match
+        return result
+
+
+class _Selection(object):
+    """ A node of a selection tree, prepared for matching raw data.
+
+        C{items} maps both path components and the raw bytes of dict
+        keys to child nodes, or C{True} for fully selected values.
+        Without a wildcard, C{skip_pairs} matches a run of dict items
+        that are not selected.
+    """
+    __slots__ = ('items', 'wildcard', 'indexed', 'skip_pairs')
+
+    def __init__(self, items, raw_keys):
+        self.items = items
+        self.wildcard = items.get('*')
+        self.indexed = any(i.isdigit() for i in items)
+        self.skip_pairs = _pair_skipper(raw_keys) if self.wildcard is None else None
+
+
+# Markers for "no pending dict key", and "not a dict"
+_NOKEY = object()
+_LIST = object()
+
+
+def _field_kind(parent, key):
+    """ Return the expected type of a container in a L{Record} field,
+        or in a list of such, given the type of its parent container.
+    """
+    if key is _LIST:
+        return parent[0] if isinstance(parent, list) else None
+    fields = getattr(parent, "FIELD_KINDS", None)
+    return None if fields is None else fields.get(key)
+
+
 class Decoder(object):
     """ Decode a string or stream to an object.
+
+        Besides strings, any buffer works as input - an C{mmap} or
+        C{memoryview} can be decoded without reading it into memory first.
+        In C{lazy} mode, string values are returned as L{LazyString}
+        views into the input, which then must stay open while they're used.
     """
 
-    def __init__(self, data, char_encoding='utf-8'):
-        """ Initialize encoder.
+    # Dispatch table of token kinds by their first byte
+    # (indexing gives an int in Python 3 and for bytearray, else a str)
+    KINDS = dict([(b'%d' % i, 's') for i in range(10)]
+                 + [(b'i', 'i'), (b'l', 'l'), (b'd', 'd'), (b'e', 'e')])
+    KINDS.update([(ord(k), v) for k, v in KINDS.items()])
+
+    # Max. number of distinct dict keys to remember
+    KEY_TABLE_SIZE = 4096
+
+    # Decoded and interned dict keys by their raw bytes, per character encoding
+    KEY_TABLES = {}
+
+    # Prepared selection trees by their paths and character encoding, see decode_select
+    SELECTIONS = {}
+
+    def __init__(self, data, char_encoding='utf-8', lazy=False, raw_fields=(), # pylint: disable=too-many-arguments
+                 dict_factory=None, list_factory=None, object_hook=None):
+        """ Initialize decoder.
+
+            @param raw_fields: Names of dict keys whose values are returned as
+                raw bytes without trying to decode them, like C{pieces}.
+                This applies to all strings in such a value, so a list
+                of byte strings can be kept raw too.
+            @param dict_factory: Mapping type used for dicts, called without
+                arguments and then filled, e.g. L{pyrobase.parts.Bunch}
+                or L{CanonicalDict}.
+            @param list_factory: Called with each finished list, e.g. C{tuple}.
+            @param object_hook: Called with each finished dict, and its result
+                is used instead of the dict.
         """
         if isinstance(data, text_type):
             self.data = data.encode(char_encoding)
+        elif isinstance(data, memoryview):
+            # Python 2 regex can't search a memoryview
+            self.data = data.tobytes() if PY2 else _BufferView(data)
         else:
             self.data = data
+        self.view = None
+        if lazy:
+            self.view = data if isinstance(data, memoryview) else memoryview(self.data)
         self.offset = 0
         self.char_encoding = char_encoding
+        self.raw_fields = frozenset(raw_fields)
+        self.dict_factory = dict_factory
+        self.list_factory = list_factory
+        self.object_hook = object_hook
+        self.key_table = self.KEY_TABLES.setdefault(char_encoding, {})
 
 
-    def decode(self, check_trailer=False): # pylint: disable=I0011,R0912
+    def decode(self, check_trailer=False, raw=False, schema=None): # pylint: disable=I0011,R0912,R0915
         """ Decode data in C{self.data} and return deserialized object.
 
+            Nested containers are handled iteratively with an explicit stack,
+            so the nesting depth of the data is not limited by the recursion
+            limit.
+
             @param check_trailer: Raise error if trailing junk is found in data?
+            @param raw: Keep all strings raw, like for a value in C{raw_fields}?
+            @param schema: L{Record} class for the top-level dict. Dicts of
+                record fields are turned into records as soon as they're
+                complete, so no full tree of plain dicts is built first.
             @raise BencodeError: Invalid data.
         """
-        if self.offset >= len(self.data):
-            raise BencodeError("Unexpected end of data at offset %d/%d" % (
-                self.offset, len(self.data),
+        data = self.data
+        find = data.find
+        size = len(data)
+        kinds = self.KINDS
+        view = self.view
+        char_encoding = self.char_encoding
+        raw_fields = self.raw_fields
+        key_table = self.key_table
+        dict_factory, list_factory, object_hook = self.dict_factory, self.list_factory, self.object_hook
+        offset = self.offset
+        stack = []  # containers under construction
+        keys = []  # pending dict key for each container, _NOKEY, or _LIST for lists
+        nokey, islist = _NOKEY, _LIST
+        raw_below = -1 if raw else None  # stack level of a container holding a raw field value
+        field_kinds = []  # expected record field type of each container, with a schema
+
+        while True:
+            kind = kinds.get(data[offset]) if offset < size else None
+            if kind == 's':
+                # String
+                try:
+                    end = find(b':', offset)
+                    if end < 0:
+                        raise ValueError("missing colon")
+                    length = _parse_int(data[offset:end], 10)
+                except (ValueError, TypeError):
+                    raise BencodeError("Bad string length at offset %d (%r...)" % (
+                        offset, data[offset:offset+32]
+                    ))
+
+                offset = end+length+1
+                if offset > size:
+                    raise BencodeError("Unexpected end of data at offset %d/%d" % (
+                        offset, size,
+                    ))
+                pending = keys[-1] if stack else islist
+                if pending is nokey:
+                    # Dict keys are shared via the key table
+                    obj = data[end+1:offset]
+                    try:
+                        obj = key_table[obj]
+                    except (KeyError, TypeError):
+                        obj = self._make_key(obj)
+                elif raw_below is not None or (raw_fields and pending in raw_fields):
+                    obj = data[end+1:offset] if view is None else LazyString(view[end+1:offset], None)
+                elif view is not None:
+                    obj = LazyString(view[end+1:offset], char_encoding)
+                else:
+                    obj = data[end+1:offset]
+
+                    if char_encoding:
+                        try:
+                            obj = obj.decode(char_encoding)
+                        except (UnicodeError, AttributeError):
+                            # deliver non-decodable string (byte arrays) as-is
+                            pass
+            elif kind == 'i':
+                # Integer
+                try:
+                    end = find(b'e', offset+1)
+                    if end < 0:
+                        raise ValueError("missing end")
+                    obj = _parse_int(data[offset+1:end], 10)
+                except (ValueError, TypeError):
+                    raise BencodeError("Bad integer at offset %d (%r...)" % (
+                        offset, data[offset:offset+32]
+                    ))
+                offset = end+1
+            elif kind == 'l' or kind == 'd':
+                # Open a list or dict, and continue with its first item
+                if raw_below is None and raw_fields and stack and keys[-1] in raw_fields:
+                    raw_below = len(stack)
+                if schema is not None:
+                    field_kinds.append(_field_kind(field_kinds[-1], keys[-1]) if stack else schema)
+                if kind == 'l':
+                    stack.append([])
+                    keys.append(islist)
+                else:
+                    stack.append({} if dict_factory is None else dict_factory())
+                    keys.append(nokey)
+                offset += 1
+                continue
+            elif kind == 'e' and stack and (keys[-1] is nokey or keys[-1] is islist):
+                # Close the innermost container, which then is a finished value
+                obj = stack.pop()
+                field_kind = field_kinds.pop() if schema is not None else None
+                if keys.pop() is islist:
+                    if list_factory is not None:
+                        obj = list_factory(obj)
+                elif getattr(field_kind, "FIELD_KINDS", None) is not None:
+                    obj = field_kind._from_fields(obj, char_encoding) # pylint: disable=protected-access
+                elif object_hook is not None:
+                    obj = object_hook(obj)
+                offset += 1
+                if raw_below == len(stack):
+                    raw_below = None
+            elif offset >= size:
+                raise BencodeError("Unexpected end of data at offset %d/%d" % (
+                    offset, size,
+                ))
+            else:
+                raise BencodeError("Format error at offset %d (%r...)" % (
+                    offset, data[offset:offset+32]
+                ))
+
+            # Add finished value to its container, or return it at the top level
+            if not stack:
+                break
+            pending = keys[-1]
+            if pending is islist:
+                stack[-1].append(obj)
+            elif pending is nokey:
+                keys[-1] = obj
+            else:
+                stack[-1][pending] = obj
+                keys[-1] = nokey
+
+        self.offset = offset
+        if check_trailer and offset != size:
+            raise BencodeError("Trailing data at offset %d (%r...)" % (
+                offset, data[offset:offset+32]
             ))
-        kind = self.data[self.offset:self.offset+1]  # get bytes of length 1, not an int^
 
-        if b'0' <= kind <= b'9':
-            # String
+        return obj
+
+
+    def _make_key(self, raw):
+        """ Decode and intern a new dict key, and add it to the key table.
+        """
+        raw = bytes(raw)
+        key = raw
+        if self.char_encoding:
             try:
-                end = self.data.find(b':', self.offset)
-                length = int(self.data[self.offset:end], 10)
-            except (ValueError, TypeError):
-                raise BencodeError("Bad string length at offset %d (%r...)" % (
-                    self.offset, self.data[self.offset:self.offset+32]
-                ))
+                key = key.decode(self.char_encoding)
+            except UnicodeError:
+                # deliver non-decodable keys as-is
+                pass
+        if type(key) is str: # pylint: disable=unidiomatic-typecheck
+            key = intern(key)
 
-            self.offset = end+length+1
-            obj = self.data[end+1:self.offset]
+        if len(self.key_table) >= self.KEY_TABLE_SIZE:
+            self.key_table.clear()
+        self.key_table[raw] = key
+        return key
 
-            if self.char_encoding:
+
+    def skip(self, ends=None):
+        """ Move past the value at the current offset, without building any objects.
+
+            @param ends: Optional dict of container end offsets by their start
+                offset, which is used to jump over known containers, and
+                gets filled with all containers scanned.
+            @return: The offset the skipped value started at.
+            @raise BencodeError: Invalid data.
+        """
+        start = offset = self.offset
+        if ends is not None and start in ends:
+            self.offset = ends[start]
+            return start
+
+        data = self.data
+        find = data.find
+        kinds = self.KINDS
+        size = len(data)
+        depth = 0
+        opened = []  # start offsets of open containers, when recording ends
+        match_one = match_run = None
+        if ends is None:
+            # Let the regex engine skip what it can, see _skip_regexes
+            match_one, match_run = _skip_regexes()
+            buf = data.view if isinstance(data, _BufferView) else data
+        while True:
+            if match_one is not None:
+                if depth:
+                    offset = match_run(buf, offset).end()
+                else:
+                    match = match_one(buf, offset)
+                    if match:
+                        offset = match.end()
+                        break
+
+            kind = kinds.get(data[offset]) if offset < size else None
+            if kind == 's':
                 try:
-                    obj = obj.decode(self.char_encoding)
-                except (UnicodeError, AttributeError):
-                    # deliver non-decodable string (byte arrays) as-is
-                    pass
-        elif kind == b'i':
-            # Integer
-            try:
-                end = self.data.find(b'e', self.offset+1)
-                obj = int(self.data[self.offset+1:end], 10)
-            except (ValueError, TypeError):
-                raise BencodeError("Bad integer at offset %d (%r...)" % (
-                    self.offset, self.data[self.offset:self.offset+32]
+                    end = find(b':', offset)
+                    if end < 0:
+                        raise ValueError("missing colon")
+                    offset = end + _parse_int(data[offset:end], 10) + 1
+                except (ValueError, TypeError):
+                    raise BencodeError("Bad string length at offset %d (%r...)" % (
+                        offset, data[offset:offset+32]
+                    ))
+                if offset > size:
+                    # don't let the regex start beyond the data
+                    raise BencodeError("Unexpected end of data at offset %d/%d" % (
+                        offset, size,
+                    ))
+            elif kind == 'i':
+                end = find(b'e', offset+1)
+                if end < 0:
+                    raise BencodeError("Bad integer at offset %d (%r...)" % (
+                        offset, data[offset:offset+32]
+                    ))
+                offset = end + 1
+            elif kind == 'l' or kind == 'd':
+                if ends is not None:
+                    opened.append(offset)
+                depth += 1
+                offset += 1
+                continue
+            elif kind == 'e' and depth:
+                depth -= 1
+                offset += 1
+                if ends is not None:
+                    ends[opened.pop()] = offset
+            elif offset >= size:
+                raise BencodeError("Unexpected end of data at offset %d/%d" % (
+                    offset, size,
                 ))
-            self.offset = end+1
-        elif kind == b'l':
-            # List
-            self.offset += 1
-            obj = []
-            while self.data[self.offset:self.offset+1] != b'e':
-                obj.append(self.decode())
-            self.offset += 1
-        elif kind == b'd':
-            # Dict
-            self.offset += 1
-            obj = {}
-            while self.data[self.offset:self.offset+1] != b'e':
-                key = self.decode()
-                obj[key] = self.decode()
-            self.offset += 1
-        else:
-            raise BencodeError("Format error at offset %d (%r...)" % (
-                self.offset, self.data[self.offset:self.offset+32]
+            else:
+                raise BencodeError("Format error at offset %d (%r...)" % (
+                    offset, data[offset:offset+32]
+                ))
+
+            if not depth:
+                break
+
+        if offset > size:
+            raise BencodeError("Unexpected end of data at offset %d/%d" % (
+                offset, size,
             ))
+        self.offset = offset
+        return start
+
+
+    def decode_select(self, paths, check_trailer=False):
+        """ Decode only the parts of the data selected by C{paths}, skipping the rest.
+
+            Paths are lists of keys joined by C{/}, where C{*} matches any
+            dict key or list item, and list items can also be selected by
+            their index. The result keeps the nesting of the full document,
+            e.g. C{["info/name", "info/files/*/length"]} returns
+            C{{"info": {"name": ..., "files": [{"length": ...}, ...]}}}.
 
+            @param paths: Sequence of path strings.
+            @param check_trailer: Raise error if trailing junk is found in data?
+            @raise BencodeError: Invalid data.
+        """
+        paths = tuple(paths)
+        selection = self.SELECTIONS.get((paths, self.char_encoding))
+        if selection is None:
+            tree = {}
+            for path in paths:
+                node = tree
+                parts = path.strip('/').split('/')
+                for part in parts[:-1]:
+                    child = node.setdefault(part, {})
+                    if child is True:
+                        break
+                    node = child
+                else:
+                    node[parts[-1]] = True
+
+            selection = self._raw_tree(_merge_wildcards(tree))
+            if len(self.SELECTIONS) >= self.KEY_TABLE_SIZE:
+                self.SELECTIONS.clear()
+            self.SELECTIONS[paths, self.char_encoding] = selection
+
+        obj = self._decode_selected(selection)
         if check_trailer and self.offset != len(self.data):
             raise BencodeError("Trailing data at offset %d (%r...)" % (
                 self.offset, self.data[self.offset:self.offset+32]
@@ -112,96 +580,1419 @@ class Decoder(object):
         return obj
 
 
+    def _raw_tree(self, tree):
+        """ Convert a selection tree to L{_Selection} nodes, which also map the raw
+            bytes of each key, so that dict keys can be matched without decoding them.
+        """
+        if tree is True:
+            return True
+        items, raw_items = {}, {}
+        for key, subtree in tree.items():
+            subtree = self._raw_tree(subtree)
+            items[key] = subtree
+            for raw in _raw_keys(key, self.char_encoding):
+                raw_items.setdefault(raw, subtree)
+        for raw, subtree in raw_items.items():
+            items.setdefault(raw, subtree)
+        return _Selection(items, raw_items)
+
+
+    def _decode_selected(self, tree): # pylint: disable=I0011,R0912,R0914,R0915
+        """ Decode the value at the current offset, restricted to the given selection tree.
+
+            Like L{decode}, this works iteratively with a stack of open
+            containers. Dict keys are looked up in the tree by their raw
+            bytes, and only decoded for selected items; everything else
+            is passed over by the skip regexes, or L{skip}.
+        """
+        data = self.data
+        find = data.find
+        size = len(data)
+        kinds = self.KINDS
+        key_table = self.key_table
+        dict_factory, list_factory, object_hook = self.dict_factory, self.list_factory, self.object_hook
+        match_one = _skip_regexes()[0]
+        match_int = _INTEGER_MATCH
+        buf = data.view if isinstance(data, _BufferView) else data
+        offset = self.offset
+        nokey = _NOKEY
+        stack = []  # open containers: [container, selection, dict key or next list index, is_dict]
+
+        while True:
+            # Start the value at the current offset, as selected by tree
+            kind = data[offset:offset+1]
+            if tree is True or (not stack and kind != b'd' and kind != b'l'):
+                # A fully selected value (or a scalar document, which has nothing to select from)
+                match = match_int(buf, offset) if kind == b'i' else None
+                if match:
+                    obj = _parse_int(match.group(1), 10)
+                    offset = match.end()
+                else:
+                    self.offset = offset
+                    obj = self.decode()
+                    offset = self.offset
+            else:
+                if kind == b'd':
+                    stack.append([{} if dict_factory is None else dict_factory(), tree, None, True])
+                else:
+                    stack.append([[], tree, 0, False])
+                offset += 1
+                obj = nokey
+
+            # Add a finished value to its container, close finished containers,
+            # and move on to the next selected item
+            while stack:
+                frame = stack[-1]
+                selection = frame[1]
+                if obj is not nokey:
+                    if frame[3]:
+                        frame[0][frame[2]] = obj
+                    else:
+                        frame[0].append(obj)
+                    obj = nokey
+                if frame[3] and selection.skip_pairs is not None:
+                    offset = selection.skip_pairs(buf, offset).end()
+
+                if offset >= size:
+                    raise BencodeError("Unexpected end of data at offset %d/%d" % (offset, size))
+                kind = kinds.get(data[offset])
+                if kind == 'e':
+                    offset += 1
+                    stack.pop()
+                    obj = frame[0]
+                    if frame[3]:
+                        if object_hook is not None:
+                            obj = object_hook(obj)
+                    elif list_factory is not None:
+                        obj = list_factory(obj)
+                    continue
+
+                if frame[3]:
+                    try:
+                        if kind != 's':
+                            raise ValueError("not a string")
+                        colon = find(b':', offset)
+                        if colon < 0:
+                            raise ValueError("missing colon")
+                        end = colon + _parse_int(data[offset:colon], 10) + 1
+                    except (ValueError, TypeError):
+                        raise BencodeError("Bad dict key at offset %d (%r...)" % (
+                            offset, data[offset:offset+32]
+                        ))
+                    if end > size:
+                        raise BencodeError("Unexpected end of data at offset %d/%d" % (end, size))
+                    raw = data[colon+1:end]
+                    if type(raw) is not binary_type: # pylint: disable=unidiomatic-typecheck
+                        raw = bytes(raw)
+                    selected = selection.items.get(raw, selection.wildcard)
+                    offset = end
+                    kind = kinds.get(data[offset]) if offset < size else None
+                else:
+                    selected = selection.wildcard
+                    if selection.indexed:
+                        selected = selection.items.get(str(frame[2]), selected)
+                    frame[2] += 1
+
+                if selected is None or (selected is not True and kind != 'd' and kind != 'l'):
+                    match = match_one(buf, offset)
+                    if match:
+                        offset = match.end()
+                    else:
+                        self.offset = offset
+                        self.skip()
+                        offset = self.offset
+                    continue
+
+                if frame[3]:
+                    key = key_table.get(raw)
+                    frame[2] = self._make_key(raw) if key is None else key
+                tree = selected
+                break
+            else:
+                self.offset = offset
+                return obj
+
+
+    def span(self, path):
+        """ Locate the raw data of the value at the given key path.
+
+            Only the keys along the path are decoded, everything else is
+            skipped. Since the data is not re-encoded, this also works for
+            non-canonical input.
+
+            @param path: Keys and list indexes joined by C{/}, the empty path
+                is the whole document.
+            @return: Tuple of start and end offset.
+            @raise KeyError: The path does not exist.
+            @raise BencodeError: Invalid data.
+        """
+        start = self._seek(path)
+        self.skip()
+        return start, self.offset
+
+
+    def _seek(self, path):
+        """ Move to the start of the value at the given key path, and return its offset.
+        """
+        self.offset = 0
+        for part in path.strip('/').split('/') if path.strip('/') else []:
+            kind = self.data[self.offset:self.offset+1]
+            if kind == b'd':
+                self.offset += 1
+                while self.data[self.offset:self.offset+1] != b'e':
+                    if _path_name(self.decode()) == part:
+                        break
+                    self.skip()
+                else:
+                    raise KeyError(path)
+            elif kind == b'l' and part.isdigit():
+                self.offset += 1
+                for _ in range(int(part, 10)):
+                    if self.data[self.offset:self.offset+1] == b'e':
+                        raise KeyError(path)
+                    self.skip()
+                if self.data[self.offset:self.offset+1] == b'e':
+                    raise KeyError(path)
+            else:
+                raise KeyError(path)
+
+        return self.offset
+
+
+    def patch_span(self, path, value):
+        """ Find the span of data to replace, so the value at C{path} is set to C{value}.
+
+            Existing values are replaced, a missing key is inserted into
+            its parent dict at the position keeping the keys sorted, and
+            a C{value} of C{None} deletes the key (or list item).
+
+            @return: Tuple of start and end offset, and the replacement data.
+            @raise KeyError: The path or its parent does not exist, or a
+                deleted key is missing.
+            @raise BencodeError: Invalid data.
+        """
+        encode = lambda obj: bencode(obj, self.char_encoding)
+        if not path.strip('/'):
+            if value is None:
+                raise KeyError(path)
+            return 0, len(self.data), encode(value)
+
+        parent, _, name = path.strip('/').rpartition('/')
+        start = self._seek(parent)
+        kind = self.data[start:start+1]
+        if kind == b'l':
+            return self.span(path) + (encode(value) if value is not None else b'',)
+        elif kind != b'd':
+            raise KeyError(path)
+
+        # Scan all keys, since non-canonical data might not be sorted
+        raw_name = name.encode(self.char_encoding or 'utf-8')
+        insert_at = None
+        self.offset = start + 1
+        while self.data[self.offset:self.offset+1] != b'e':
+            key_start = self.offset
+            key = self.decode()
+            if isinstance(key, LazyString):
+                key = key.value
+            raw_key = key if isinstance(key, binary_type) else key.encode(self.char_encoding or 'utf-8')
+            value_start = self.skip()
+            if raw_key == raw_name:
+                if value is None:
+                    return key_start, self.offset, b''
+                return value_start, self.offset, encode(value)
+            elif raw_key > raw_name and insert_at is None:
+                insert_at = key_start
+
+        if value is None:
+            raise KeyError(path)
+        if insert_at is None:
+            insert_at = self.offset
+        return insert_at, insert_at, encode(name) + encode(value)
+
+
+
+def _merge_tree(tree, other):
+    """ Return the union of two selection trees.
+    """
+    if tree is True or other is True:
+        return True
+    merged = dict(tree)
+    for key, subtree in other.items():
+        merged[key] = _merge_tree(merged[key], subtree) if key in merged else subtree
+    return merged
+
+
+def _merge_wildcards(tree):
+    """ Merge the C{*} branch of a selection tree into its named siblings,
+        so that a specific path does not hide the wildcard selection.
+    """
+    if tree is True:
+        return True
+    wildcard = tree.get('*')
+    return dict((key, _merge_wildcards(subtree if wildcard is None or key == '*'
+                                       else _merge_tree(subtree, wildcard)))
+                for key, subtree in tree.items())
+
+
+def _raw_keys(key, char_encoding):
+    """ Return the raw forms of dict keys that match a key path component.
+
+        Keys are matched after decoding them, and those that
+        can't be decoded via Latin-1, see L{_path_name}.
+    """
+    if isinstance(key, binary_type):
+        return [key]  # Python 2 byte string path
+
+    result = []
+    if char_encoding:
+        try:
+            result.append(key.encode(char_encoding))
+        except UnicodeError:
+            pass
+    try:
+        raw = key.encode('latin-1')
+        if char_encoding:
+            raw.decode(char_encoding)
+    except UnicodeDecodeError:
+        result.append(raw)
+    except UnicodeEncodeError:
+        pass
+    else:
+        if not char_encoding:
+            result.append(raw)
+    return result
+
+
+def _path_name(key):
+    """ Convert a decoded dict key for matching against key path components.
+    """
+    return key.decode('latin-1') if isinstance(key, binary_type) else text_type(key)
+
+
+class Bencoded(object):
+    """ Data that is already bencoded, and is written by the encoder as-is.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        return isinstance(other, Bencoded) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __repr__(self):
+        return "Bencoded(<%d bytes>)" % len(self.data)
+
+
+class EncodingCache(object):
+    """ Remember the encoded form of subtrees that don't change between encoder runs.
+
+        Values of the dict keys named in C{keys} are encoded once, and then
+        spliced into later outputs as raw bytes. By default, cache entries are
+        keyed by object identity, so a changed subtree must be a new object,
+        or else be dropped via L{invalidate}. Alternatively, pass a C{version}
+        callable that returns a hashable key for a subtree's current state
+        (like a counter or a hash you already have).
+    """
+
+    def __init__(self, keys=('info',), version=None, max_entries=10000):
+        """ Initialize cache.
+        """
+        self.keys = set(keys) | set(i.encode('utf-8') for i in keys if isinstance(i, text_type))
+        self.version = version
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = self.misses = 0
+
+    def encoded(self, obj, encoder):
+        """ Return the encoded form of C{obj} as a L{Bencoded} object, from cache
+            if possible.
+        """
+        key = id(obj) if self.version is None else self.version(obj)
+        entry = self.entries.get(key)
+        if entry is not None and (entry[0] is obj or self.version is not None):
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        data = Bencoded(b''.join(Encoder(encoder.char_encoding, encoder.chunk_size, cache=self).iterencode(obj)))
+        if len(self.entries) >= self.max_entries:
+            self.entries.clear()
+        # Keep identity-keyed objects alive, so their id is not re-used
+        self.entries[key] = (obj if self.version is None else None, data)
+        return data
+
+    def invalidate(self, obj=None):
+        """ Forget the cached form of C{obj}, or of everything.
+        """
+        if obj is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(id(obj) if self.version is None else self.version(obj), None)
+
+
+# Plain dicts keep their insertion order since Python 3.7
+_InsertionOrderedDict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+
+class CanonicalDict(_InsertionOrderedDict):
+    """ A dict whose keys are known to be in canonical (sorted) order.
+
+        The encoder writes its items as they are, without sorting them.
+        It is the caller's job to keep the order intact on changes.
+    """
+
 
 class Encoder(object):
     """ Encode a given object to an array of bytestrings.
+
+        The encoder works iteratively and collects output in a buffer,
+        which is handed out in chunks of about C{chunk_size} bytes
+        (strings bigger than that are passed on as-is).
     """
 
-    def __init__(self, char_encoding='utf-8'):
+    # Default size of output chunks
+    CHUNK_SIZE = 65536
+
+    # Max. number of encoded dict keys to remember
+    KEY_CACHE_SIZE = 4096
+
+    # Encoding kind by type, filled on demand by L{kind_of}
+    KINDS = {}
+
+    # Encoded dict keys, per character encoding
+    KEY_CACHES = {}
+
+    def __init__(self, char_encoding='utf-8', chunk_size=CHUNK_SIZE, cache=None):
         """ Initialize encoder.
+
+            @param cache: Optional L{EncodingCache} for unchanging subtrees.
         """
         self.result = []
         self.char_encoding = char_encoding
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.key_cache = self.KEY_CACHES.setdefault(char_encoding, {})
 
-    def encode(self, obj):
-        """ Add the given object to the result.
+    @classmethod
+    def kind_of(cls, obj):
+        """ Return the encoding kind for the type of C{obj}, and remember it.
         """
         if isinstance(obj, bool):
-            self.result.append(b"i1e" if obj else b"i0e")
+            kind = 'b'
         elif isinstance(obj, integer_types):
-            self.result.extend([b"i", text_type(obj).encode(self.char_encoding), b"e"])
-        elif isinstance(obj, string_types):
-            if isinstance(obj, text_type):
-                obj = obj.encode(self.char_encoding)
-            self.result.extend([str(len(obj)).encode(self.char_encoding), b':', obj])
-        elif isinstance(obj, binary_type):
-            # Previous check catches py2's str
-            self.result.extend([str(len(obj)).encode(self.char_encoding), b':', obj])
+            kind = 'i'
+        elif isinstance(obj, text_type):
+            kind = 't'
+        elif isinstance(obj, (binary_type, bytearray, memoryview)):
+            kind = 's'
+        elif isinstance(obj, Bencoded):
+            kind = 'r'
         elif hasattr(obj, "__bencode__"):
-            self.encode(obj.__bencode__())
+            kind = 'x'
+        elif isinstance(obj, CanonicalDict):
+            kind = 'D'
         elif hasattr(obj, "items"):
-            # Dictionary
-            self.result.append(b'd')
-            for key, val in sorted(obj.items()):
-                if isinstance(key, integer_types):
-                    key = text_type(key).encode(self.char_encoding)
-                if not isinstance(key, string_types + (binary_type,)):
-                    raise BencodeError("Dict key must be bytestring, found '%s'" % key)
-                if isinstance(key, text_type):
-                    key = key.encode(self.char_encoding)
-                self.result.extend([str(len(key)).encode(self.char_encoding), b':', key])
-                self.encode(val)
-            self.result.append(b'e')
+            kind = 'd'
         else:
-            # Treat as iterable
-            try:
-                items = iter(obj)
-            except TypeError as exc:
-                raise BencodeError("Unsupported non-iterable object %r of type %s (%s)" % (
-                    obj, type(obj), exc
-                ))
-            else:
-                self.result.append(b'l')
-                for item in items:
-                    self.encode(item)
-                self.result.append(b'e')
+            kind = 'l'
+
+        cls.KINDS[type(obj)] = kind
+        return kind
 
+    def encode(self, obj):
+        """ Add the given object to the result.
+        """
+        self.result.extend(self.iterencode(obj))
         return self.result
 
+    def iterencode(self, obj): # pylint: disable=I0011,R0912
+        """ Encode the given object, and yield the output in chunks.
+        """
+        chunk_size = self.chunk_size
+        kinds = self.KINDS
+        buf = bytearray()
+        stack = []  # iterators of the enclosing containers, and their closing bytes
+        items, closing = iter((obj,)), b''
 
-def bdecode(data, char_encoding='utf-8'):
-    """ Decode a string or stream to an object.
+        while True:
+            for obj in items:
+                kind = kinds.get(type(obj)) or self.kind_of(obj)
+                if kind == 's' or kind == 't':
+                    if kind == 't':
+                        obj = obj.encode(self.char_encoding)
+                    buf += b"%d:" % len(obj)
+                    if len(obj) >= chunk_size:
+                        # Pass big strings on without copying them
+                        yield bytes(buf)
+                        yield obj
+                        del buf[:]
+                        continue
+                    buf += obj
+                elif kind == 'i':
+                    buf += b"i%de" % obj
+                elif kind == 'b':
+                    buf += b"i1e" if obj else b"i0e"
+                elif kind == 'd' or kind == 'D':
+                    # Dictionary
+                    buf += b'd'
+                    stack.append((items, closing))
+                    items, closing = self._dict_values(obj, buf, presorted=kind == 'D'), b'e'
+                    break
+                elif kind == 'r':
+                    if len(obj) >= chunk_size:
+                        yield bytes(buf)
+                        yield obj.data
+                        del buf[:]
+                        continue
+                    buf += obj.data
+                elif kind == 'x':
+                    stack.append((items, closing))
+                    items, closing = iter((obj.__bencode__(),)), b''
+                    break
+                else:
+                    # Treat as iterable
+                    try:
+                        obj = iter(obj)
+                    except TypeError as exc:
+                        raise BencodeError("Unsupported non-iterable object %r of type %s (%s)" % (
+                            obj, type(obj), exc
+                        ))
+                    buf += b'l'
+                    stack.append((items, closing))
+                    items, closing = obj, b'e'
+                    break
+
+                if len(buf) >= chunk_size:
+                    yield bytes(buf)
+                    del buf[:]
+            else:
+                # Current container is done
+                if not stack:
+                    break
+                buf += closing
+                items, closing = stack.pop()
+
+        if buf:
+            yield bytes(buf)
+
+    def _dict_values(self, obj, buf, presorted=False):
+        """ Add the sorted keys of a dict to the buffer, each one just before
+            its value is yielded.
+        """
+        key_cache = self.key_cache
+        cache = self.cache
+        for key, val in obj.items() if presorted else sorted(obj.items()):
+            encoded = key_cache.get(key)
+            if encoded is None:
+                encoded = self._encode_key(key)
+            buf += encoded
+            if cache is not None and key in cache.keys:
+                val = cache.encoded(val, self)
+            yield val
+
+    def _encode_key(self, key):
+        """ Return the encoded form of a dict key, caching string keys.
+        """
+        orig_key = key
+        if isinstance(key, integer_types):
+            key = text_type(key).encode(self.char_encoding)
+        if not isinstance(key, string_types + (binary_type,)):
+            raise BencodeError("Dict key must be bytestring, found '%s'" % key)
+        if isinstance(key, text_type):
+            key = key.encode(self.char_encoding)
+
+        encoded = b"%d:%s" % (len(key), key)
+        if isinstance(orig_key, string_types + (binary_type,)):
+            if len(self.key_cache) >= self.KEY_CACHE_SIZE:
+                self.key_cache.clear()
+            self.key_cache[orig_key] = encoded
+        return encoded
+
+
+class IncrementalDecoder(object):
+    """ Decode a sequence of top-level objects from data arriving in chunks.
+
+        Feed it whatever a socket or pipe delivers, and it returns each
+        object as soon as its last byte arrived. Only the data of the
+        object currently in transit is buffered.
+    """
+
+    def __init__(self, char_encoding='utf-8'):
+        """ Initialize decoder.
+        """
+        self.char_encoding = char_encoding
+        self.buffer = bytearray()
+        self.position = 0  # stream offset of C{self.buffer[0]}
+        self.offset = 0  # buffer offset of the next token not yet scanned
+        self.depth = 0  # container nesting level at C{self.offset}
+
+
+    def feed(self, chunk):
+        """ Add a chunk of data, and return a list of all objects completed by it.
+
+            @raise BencodeError: Invalid data.
+        """
+        if isinstance(chunk, text_type):
+            chunk = chunk.encode(self.char_encoding)
+        self.buffer.extend(chunk)
+
+        result = []
+        end = self._scan()
+        while end:
+            result.append(Decoder(bytes(self.buffer[:end]), self.char_encoding).decode(check_trailer=True))
+            del self.buffer[:end]
+            self.position += end
+            end = self._scan()
+
+        return result
+
+
+    def close(self):
+        """ Signal end of data.
+
+            @raise BencodeError: Data of an incomplete object is left over.
+        """
+        if self.buffer:
+            raise BencodeError("Unexpected end of data at offset %d (%r...)" % (
+                self.position + len(self.buffer), bytes(self.buffer[:32]),
+            ))
+
+
+    def _scan(self):
+        """ Scan tokens in the buffer, continuing where the last call left off.
+
+            @return: Buffer offset after the first complete object, or C{None}.
+        """
+        data = self.buffer
+        size = len(data)
+        offset, depth = self.offset, self.depth
+
+        while offset < size:
+            kind = data[offset:offset+1]
+            if kind == b'i':
+                end = data.find(b'e', offset+1)
+                if end < 0:
+                    break
+                offset = end + 1
+            elif kind == b'l' or kind == b'd':
+                depth += 1
+                offset += 1
+                self.offset, self.depth = offset, depth
+                continue
+            elif kind == b'e' and depth:
+                depth -= 1
+                offset += 1
+            elif b'0' <= kind <= b'9':
+                end = data.find(b':', offset)
+                if end < 0:
+                    if not data[offset:].isdigit():
+                        raise BencodeError("Bad string length at offset %d (%r...)" % (
+                            self.position + offset, bytes(data[offset:offset+32])
+                        ))
+                    break
+                try:
+                    length = int(bytes(data[offset:end]), 10)  # Python 2 int() rejects a bytearray
+                except (ValueError, TypeError):
+                    raise BencodeError("Bad string length at offset %d (%r...)" % (
+                        self.position + offset, bytes(data[offset:offset+32])
+                    ))
+                if end + length + 1 > size:
+                    break
+                offset = end + length + 1
+            else:
+                raise BencodeError("Format error at offset %d (%r...)" % (
+                    self.position + offset, bytes(data[offset:offset+32])
+                ))
+
+            # A scalar or a closed container is complete, remember that
+            self.offset, self.depth = offset, depth
+            if not depth:
+                self.offset = 0
+                return offset
+
+        return None
+
+
+@add_metaclass(ABCMeta)
+class BencodeView(object):
+    """ Read-only view of a bencoded dict or list, decoding items on demand.
+
+        A view indexes the offsets of its own items on first access,
+        nested containers become views again, and scalar items are
+        decoded and cached when accessed. So only the parts of
+        a document that are actually looked at are ever decoded.
+        The end offsets of all containers passed over while indexing are
+        remembered, so that nested views never scan the same data again.
+        Use L{bview} to create a view.
+    """
+
+    def __init__(self, decoder, offset, ends, raw=False):
+        """ Initialize view of the container at C{offset}, using C{decoder}.
+
+            C{ends} is the table of known container end offsets, shared
+            by all views of a document (see L{Decoder.skip}). With C{raw}
+            set, the container is the value of one of the decoder's
+            C{raw_fields}, and all its strings are kept raw.
+        """
+        self._decoder = decoder
+        self._offset = offset
+        self._ends = ends
+        self._raw = raw
+        self._end = None
+        self._index = None
+        self._cache = {}
+
+    @abstractmethod
+    def _build_index(self):
+        """ Scan the items of this container, and return their offsets.
+        """
+
+    def _get_index(self):
+        """ Return the index, building it on first use.
+        """
+        if self._index is None:
+            self._index = self._build_index()
+        return self._index
+
+    @property
+    def span(self):
+        """ Start and end offset of the raw data of this container.
+        """
+        self._get_index()
+        return self._offset, self._end
+
+    def decode(self):
+        """ Return the fully decoded container.
+        """
+        self._decoder.offset = self._offset
+        return self._decoder.decode(raw=self._raw)
+
+    def __len__(self):
+        return len(self._get_index())
+
+
+class BencodeDictView(BencodeView, Mapping):
+    """ Read-only mapping view of a bencoded dict.
+    """
+
+    def _build_index(self):
+        decoder = self._decoder
+        index = OrderedDict() if PY2 else {}
+        decoder.offset = self._offset + 1
+        while decoder.data[decoder.offset:decoder.offset+1] != b'e':
+            key = decoder.decode()
+            if isinstance(key, LazyString):
+                key = key.value
+            index[key] = decoder.skip(self._ends)
+        self._end = decoder.offset + 1
+        return index
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = _view_item(self._decoder, self._get_index()[key], self._ends,
+                                                  self._raw or key in self._decoder.raw_fields)
+            return value
+
+    def __iter__(self):
+        return iter(self._get_index())
+
+    def __contains__(self, key):
+        return key in self._get_index()
+
+    def __repr__(self):
+        return "BencodeDictView(%s)" % ', '.join(repr(i) for i in self)
+
+
+class BencodeListView(BencodeView, Sequence):
+    """ Read-only sequence view of a bencoded list.
+    """
+
+    def _build_index(self):
+        decoder = self._decoder
+        index = []
+        decoder.offset = self._offset + 1
+        while decoder.data[decoder.offset:decoder.offset+1] != b'e':
+            index.append(decoder.skip(self._ends))
+        self._end = decoder.offset + 1
+        return index
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        try:
+            return self._cache[idx]
+        except KeyError:
+            value = self._cache[idx] = _view_item(self._decoder, self._get_index()[idx], self._ends, self._raw)
+            return value
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, string_types + (binary_type,)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "BencodeListView(<%d items>)" % len(self)
+
+
+def _view_item(decoder, start, ends, raw=False):
+    """ Return a view or the decoded value of the item at offset C{start}.
+    """
+    kind = decoder.data[start:start+1]
+    if kind == b'd':
+        return BencodeDictView(decoder, start, ends, raw)
+    elif kind == b'l':
+        return BencodeListView(decoder, start, ends, raw)
+    else:
+        decoder.offset = start
+        return decoder.decode(raw=raw)
+
+
+def bview(data, char_encoding='utf-8', **kwargs):
+    """ Return a L{BencodeView} of the dict or list in C{data} (which is
+        typically an C{mmap}), or the decoded value of a scalar document.
+
+        Other keyword arguments are passed on to L{Decoder}, and only
+        affect decoding of accessed items.
     """
-    return Decoder(data, char_encoding).decode(check_trailer=True)
+    return _view_item(Decoder(data, char_encoding, **kwargs), 0, {})
+
+
+class Record(object):
+    """ Base class of slotted records for dicts of a known schema, see L{record_type}.
+
+        Known keys are stored in slots, and unknown ones in the C{extra} dict,
+        so records can be encoded again without losing anything.
+    """
+    __slots__ = ('_extra',)
+
+    # Tuples of dict key, attribute name, and field type
+    FIELDS = ()
+
+    # Field types by dict key
+    FIELD_KINDS = {}
+
+    def __init__(self, **kwargs):
+        for _, attr, _ in self.FIELDS:
+            setattr(self, attr, kwargs.pop(attr, None))
+        self._extra = kwargs or None
+
+    @property
+    def extra(self):
+        """ Dict of the unknown keys.
+        """
+        if self._extra is None:
+            self._extra = {}
+        return self._extra
+
+    @classmethod
+    def raw_keys(cls):
+        """ Return the names of all keys with C{bytes} values, including nested records.
+        """
+        result = set()
+        for key, _, kind in cls.FIELDS:
+            kind = kind[0] if isinstance(kind, list) else kind
+            if kind is binary_type:
+                result.add(key)
+            elif isinstance(kind, type) and issubclass(kind, Record) and kind is not cls:
+                result.update(kind.raw_keys())
+        return result
+
+    @classmethod
+    def from_dict(cls, obj, char_encoding='utf-8'):
+        """ Create a record from a decoded dict, checking the field types.
 
+            @raise BencodeError: A value has the wrong type.
+        """
+        if not hasattr(obj, "items"):
+            raise BencodeError("Expected a dict for %s, got %r" % (cls.__name__, type(obj)))
+        return cls._from_fields(dict(obj), char_encoding)
+
+    @classmethod
+    def _from_fields(cls, extra, char_encoding):
+        """ Create a record from a dict, which is emptied of the known keys
+            and then kept for the unknown ones.
+        """
+        record = cls.__new__(cls)
+        for key, attr, kind in cls.FIELDS:
+            value = extra.pop(key, None)
+            if value is not None:
+                value = _record_value(value, kind, key, char_encoding)
+            setattr(record, attr, value)
+        record._extra = extra or None # pylint: disable=protected-access
+        return record
+
+    def to_dict(self):
+        """ Return the record as a plain dict, with nested records converted too.
+        """
+        result = dict(self._extra or {})
+        for key, attr, _ in self.FIELDS:
+            value = getattr(self, attr)
+            if isinstance(value, Record):
+                value = value.to_dict()
+            elif isinstance(value, list):
+                value = [i.to_dict() if isinstance(i, Record) else i for i in value]
+            if value is not None:
+                result[key] = value
+        return result
+
+    def __bencode__(self):
+        return self.to_dict()
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return type(self) is type(other) and self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % (attr, getattr(self, attr)) for _, attr, _ in self.FIELDS
+            if getattr(self, attr) is not None
+        ))
+
+
+def _record_value(value, kind, key, char_encoding):
+    """ Check and convert a decoded value for a record field.
+    """
+    if isinstance(kind, list):
+        if not isinstance(value, (list, tuple)):
+            raise BencodeError("Expected a list for %r, got %r" % (key, type(value)))
+        return [_record_value(i, kind[0], key, char_encoding) for i in value]
+    elif isinstance(kind, type) and issubclass(kind, Record):
+        return value if isinstance(value, kind) else kind.from_dict(value, char_encoding)
+    elif kind is binary_type and isinstance(value, text_type):
+        return value.encode(char_encoding or 'utf-8')
+    elif kind is text_type and isinstance(value, binary_type):
+        # keep non-decodable strings as-is
+        return value
+    elif kind is int and isinstance(value, integer_types):
+        return value
+    elif not isinstance(value, kind):
+        raise BencodeError("Expected %s for %r, got %r" % (kind.__name__, key, type(value)))
+    return value
 
-def bencode(obj, char_encoding='utf-8'):
+
+def record_type(name, fields):
+    """ Create a L{Record} class for dicts with the given fields.
+
+        Attribute names are the keys with any non-identifier characters
+        replaced by C{_}, so C{"piece length"} becomes C{piece_length}.
+        Missing keys are set to C{None}.
+
+        @raise ValueError: Two keys map to the same attribute name,
+            or one clashes with a L{Record} attribute.
+
+        @param name: Class name.
+        @param fields: Sequence of C{(key, type)} pairs (or a dict); types
+            are C{int}, C{bytes}, C{str} (text), C{list}, C{dict}, another
+            record class, or a list with one of these for lists of items
+            of that type.
+    """
+    fields = tuple(fields.items() if hasattr(fields, "items") else fields)
+    spec = tuple((key, re.sub(r"\W|^(?=\d)", "_", key), kind) for key, kind in fields)
+    keys = {}
+    for key, attr, _ in spec:
+        if attr in keys:
+            raise ValueError("Keys %r and %r of %s both map to attribute %r" % (keys[attr], key, name, attr))
+        if hasattr(Record, attr):
+            raise ValueError("Key %r of %s clashes with the Record attribute %r" % (key, name, attr))
+        keys[attr] = key
+    return type(str(name), (Record,), dict(__slots__=tuple(attr for _, attr, _ in spec),
+                                           FIELDS=spec, FIELD_KINDS=dict(fields)))
+
+
+def bdecode(data, char_encoding='utf-8', select=None, schema=None, **kwargs):
+    """ Decode a string or buffer to an object.
+
+        Pass a list of key paths in C{select} to only decode those
+        parts of the data, see L{Decoder.decode_select}.
+        With a L{Record} class passed in C{schema}, a record of that
+        type is returned instead of a dict, and C{bytes} fields are
+        added to the C{raw_fields}.
+        Other keyword arguments are passed on to L{Decoder}.
+    """
+    if schema is not None:
+        kwargs["raw_fields"] = set(kwargs.get("raw_fields", ())) | schema.raw_keys()
+    decoder = Decoder(data, char_encoding, **kwargs)
+    if select is None:
+        obj = decoder.decode(check_trailer=True, schema=schema)
+    else:
+        obj = decoder.decode_select(select, check_trailer=True)
+    if schema is not None and not isinstance(obj, schema):
+        obj = schema.from_dict(obj, char_encoding)
+    return obj
+
+
+def bspan(data, path):
+    """ Return start and end offset of the raw value at the given key path in data,
+        see L{Decoder.span}.
+    """
+    return Decoder(data).span(path)
+
+
+def bencode(obj, char_encoding='utf-8', cache=None):
     """ Encode a given object to data.
     """
-    return b''.join(Encoder(char_encoding).encode(obj))
+    return b''.join(Encoder(char_encoding, cache=cache).iterencode(obj))
 
 
-def bread(stream):
+def bencode_iter(obj, char_encoding='utf-8', chunk_size=Encoder.CHUNK_SIZE, cache=None):
+    """ Encode a given object to data, yielding it in chunks.
+    """
+    return Encoder(char_encoding, chunk_size, cache=cache).iterencode(obj)
+
+
+def _mmap(handle):
+    """ Return a read-only memory map of an open file, or C{None}.
+
+        On Python 2, C{None} is always returned, since a memoryview
+        cannot be taken from an C{mmap} there.
+    """
+    if PY2:
+        return None
+    try:
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        # no real file, or empty
+        return None
+
+
+def bread(stream, lazy=False, **kwargs):
     """ Decode a file or stream to an object.
+
+        With C{lazy} set, files are memory-mapped and string values are
+        returned as L{LazyString} objects, so the data isn't read
+        until it's accessed. Other keyword arguments are passed on to
+        L{bdecode}.
     """
     if hasattr(stream, "read"):
-        return bdecode(stream.read())
+        data = _mmap(stream) if lazy else None
+        return bdecode(stream.read() if data is None else data, lazy=lazy, **kwargs)
     else:
         handle = open(stream, "rb")
         try:
-            return bdecode(handle.read())
+            data = _mmap(handle) if lazy else None
+            return bdecode(handle.read() if data is None else data, lazy=lazy, **kwargs)
         finally:
             handle.close()
 
 
-def bwrite(stream, obj):
-    """ Encode a given object to a file or stream.
+def bread_iter(stream, char_encoding='utf-8', chunk_size=65536):
+    """ Decode a file, pipe or socket stream to a sequence of objects,
+        yielding each one as soon as it has arrived.
+    """
+    read = getattr(stream, "read1", None) or stream.read
+    decoder = IncrementalDecoder(char_encoding)
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        for obj in decoder.feed(chunk):
+            yield obj
+    decoder.close()
+
+
+def bwrite(stream, obj, chunk_size=Encoder.CHUNK_SIZE, cache=None):
+    """ Encode a given object to a file, stream or socket.
+
+        The data is written in chunks as it's encoded, so the whole
+        encoded object is never held in memory. That also means a
+        stream or socket might already have received part of the data
+        when encoding fails; a file given by name is left empty then.
     """
     handle = None
-    if not hasattr(stream, "write"):
+    if not hasattr(stream, "write") and not hasattr(stream, "sendall"):
         stream = handle = open(stream, "wb")
     try:
-        stream.write(bencode(obj))
+        write = getattr(stream, "write", None) or stream.sendall
+        for chunk in Encoder(chunk_size=chunk_size, cache=cache).iterencode(obj):
+            write(chunk)
+    except BaseException:
+        if handle:
+            handle.seek(0)
+            handle.truncate()
+        raise
     finally:
         if handle:
             handle.close()
+
+
+def _patch_edits(data, changes, char_encoding):
+    """ Return the sorted list of C{(start, end, replacement)} edits for C{changes}.
+    """
+    decoder = Decoder(data, char_encoding)
+    edits = []
+    for path, value in changes.items():
+        start, end, replacement = decoder.patch_span(path, value)
+        # new keys inserted at the same position must be in key order
+        name = path.strip('/').rpartition('/')[2].encode(char_encoding or 'utf-8')
+        edits.append((start, end, name, replacement))
+    edits.sort()
+
+    for prev, edit in zip(edits, edits[1:]):
+        if edit[0] < prev[1]:
+            raise ValueError("Overlapping changes at offset %d" % edit[0])
+    return [(start, end, replacement) for start, end, _, replacement in edits]
+
+
+def bpatch(data, changes, char_encoding='utf-8'):
+    """ Apply changes to bencoded data, without decoding and re-encoding all of it.
+
+        Only the keys along the changed paths are decoded, and the new
+        values are spliced into the original data. That keeps everything
+        else byte-for-byte as it was, even for non-canonical input.
+
+        @param changes: Mapping of key paths (see L{Decoder.span}) to new values,
+            where C{None} deletes a key or list item.
+        @return: The patched data.
+        @raise KeyError: A path, or the parent of a new key, does not exist.
+        @raise ValueError: Changes overlap, e.g. a path and one of its children.
+        @raise BencodeError: Invalid data.
+    """
+    view = memoryview(data)
+    result, pos = [], 0
+    for start, end, replacement in _patch_edits(data, changes, char_encoding):
+        result.extend((view[pos:start], replacement))
+        pos = end
+    result.append(view[pos:])
+    if PY2:
+        # str.join doesn't take memoryviews
+        result = [i.tobytes() if isinstance(i, memoryview) else i for i in result]
+    return b''.join(result)
+
+
+def _copy_range(source, target, data, offset, count):
+    """ Copy a range of the C{source} file to C{target}, in the kernel where possible.
+    """
+    sendfile = getattr(os, "sendfile", None)
+    if sendfile and count:
+        target.flush()
+    while count and sendfile:
+        try:
+            sent = sendfile(target.fileno(), source.fileno(), offset, count)
+        except OSError:
+            # not supported for regular files on this platform
+            break
+        if not sent:
+            break
+        offset += sent
+        count -= sent
+    if count:
+        target.write(memoryview(data)[offset:offset+count])
+
+
+def bpatch_file(filename, changes, char_encoding='utf-8', fsync=True):
+    """ Apply changes to a bencoded file in place, see L{bpatch}.
+
+        The file is memory-mapped to locate the changed values, and a
+        patched copy is written to a temporary file next to it, which
+        then replaces the original atomically. Unchanged data is copied
+        via C{sendfile} where available, else from the memory map, but
+        never decoded.
+
+        @param fsync: Flush the new file to disk before the rename?
+        @raise EnvironmentError: The file cannot be read or written.
+    """
+    import shutil
+    import tempfile
+
+    with open(filename, "rb") as source:
+        data = _mmap(source)
+        if data is None:
+            data = source.read()
+        try:
+            edits = _patch_edits(data, changes, char_encoding)
+            fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                                           dir=os.path.dirname(os.path.abspath(filename)))
+            try:
+                with io.open(fd, "wb") as target:
+                    pos = 0
+                    for start, end, replacement in edits + [(len(data), len(data), b'')]:
+                        _copy_range(source, target, data, pos, start - pos)
+                        target.write(replacement)
+                        pos = end
+                    target.flush()
+                    if fsync:
+                        os.fsync(target.fileno())
+                shutil.copymode(filename, tmpname)
+                getattr(os, "replace", os.rename)(tmpname, filename)
+            except BaseException:
+                os.remove(tmpname)
+                raise
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def _is_path(source):
+    """ Check whether C{source} is a filename, rather than data.
+    """
+    if isinstance(source, text_type):
+        return True
+    if PY2 and isinstance(source, binary_type):
+        try:
+            return os.path.isfile(source)
+        except (TypeError, ValueError):
+            # data with NUL bytes
+            return False
+    return False
+
+
+def info_hash(source, algorithm='sha1'):
+    """ Return the hex digest of the raw C{info} dict of a metafile.
+
+        The hash is calculated over the original bytes, so it stays correct for
+        non-canonically encoded input and needs no decode / re-encode round trip.
+
+        @param source: Path (a text string), open file, or buffer with the metafile data.
+            On Python 2, a byte string naming an existing file is a path too.
+        @param algorithm: C{sha1} for v1 info hashes, C{sha256} for v2.
+        @raise KeyError: There is no C{info} dict.
+        @raise BencodeError: Invalid data.
+    """
+    handle = mapped = None
+    if _is_path(source):
+        source = handle = open(source, "rb")
+    try:
+        if hasattr(source, "read"):
+            mapped = _mmap(source)
+            source = source.read() if mapped is None else mapped
+        start, end = bspan(source, 'info')
+        return hashlib.new(algorithm, memoryview(source)[start:end]).hexdigest()
+    finally:
+        if mapped is not None:
+            mapped.close()
+        if handle:
+            handle.close()
+
+
+def _json_binary(data, binary, chunk_size):
+    """ Yield a binary string as a JSON string in C{hex} or C{base64} form, in chunks.
+    """
+    if binary == 'hex':
+        step, convert = chunk_size // 2, binascii.hexlify
+    else:
+        step, convert = chunk_size // 4 * 3, base64.b64encode
+    yield '"'
+    for pos in range(0, len(data), step or 1):
+        yield convert(data[pos:pos+step]).decode('ascii')
+    yield '"'
+
+
+def bjson_iter(data, char_encoding='utf-8', binary='hex', elide=(), chunk_size=65536): # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+    """ Convert bencoded data to JSON, yielding the text in chunks.
+
+        The JSON text is produced directly while scanning the data,
+        without building the decoded object tree, so memory use only
+        depends on the size of the largest string.
+
+        Strings that are not valid in C{char_encoding} are converted to
+        C{hex} or C{base64} JSON strings (this also applies to dict keys),
+        and long ones are converted in pieces. Values of dict keys listed in
+        C{elide} (e.g. C{pieces}) are skipped, and replaced by
+        C{{"elided":<size of the raw value>}}.
+
+        @raise BencodeError: Invalid data, including trailing junk.
+        @raise ValueError: Unknown C{binary} format.
+    """
+    import json
+
+    if binary not in ('hex', 'base64'):
+        raise ValueError("Unknown binary format %r" % (binary,))
+    elide = frozenset(elide)
+    decoder = Decoder(data, char_encoding)
+    data = decoder.data
+    find = data.find
+    size = len(data)
+    kinds = Decoder.KINDS
+
+    buf, buf_size = [], 0
+    stack = []  # open containers, as [kind, item count]
+    offset = 0
+    key = None  # last dict key seen
+    while True:
+        if offset >= size:
+            raise BencodeError("Unexpected end of data at offset %d/%d" % (offset, size))
+        kind = kinds.get(data[offset])
+        parts = []
+        if kind == 'e' and stack:
+            container = stack.pop()
+            if container[0] == 'd' and container[1] % 2:
+                raise BencodeError("Missing dict value at offset %d" % offset)
+            parts.append('}' if container[0] == 'd' else ']')
+            offset += 1
+        else:
+            is_key = False
+            if stack:
+                container = stack[-1]
+                is_key = container[0] == 'd' and not container[1] % 2
+                if container[1]:
+                    parts.append(':' if container[0] == 'd' and not is_key else ',')
+                container[1] += 1
+                if is_key and kind != 's':
+                    raise BencodeError("Dict key must be a string at offset %d" % offset)
+
+            if stack and not is_key and stack[-1][0] == 'd' and key in elide:
+                decoder.offset = offset
+                start = decoder.skip()
+                offset = decoder.offset
+                parts.append('{"elided":%d}' % (offset - start))
+            elif kind == 's':
+                try:
+                    colon = find(b':', offset)
+                    if colon < 0:
+                        raise ValueError("missing colon")
+                    end = colon + 1 + _parse_int(data[offset:colon], 10)
+                except (ValueError, TypeError):
+                    raise BencodeError("Bad string length at offset %d (%r...)" % (
+                        offset, data[offset:offset+32]
+                    ))
+                if end > size:
+                    raise BencodeError("Truncated string at offset %d" % offset)
+                raw = data[colon+1:end]
+                offset = end
+                try:
+                    text = raw.decode(char_encoding) if char_encoding else None
+                except UnicodeError:
+                    text = None
+                if is_key:
+                    key = text if text is not None else _path_name(bytes(raw))
+                if text is not None:
+                    parts.append(json.dumps(text))
+                else:
+                    parts = itertools.chain(parts, _json_binary(raw, binary, chunk_size))
+            elif kind == 'i':
+                end = find(b'e', offset)
+                try:
+                    if end < 0:
+                        raise ValueError("unterminated")
+                    parts.append(text_type(_parse_int(data[offset+1:end], 10)))
+                except (ValueError, TypeError):
+                    raise BencodeError("Bad integer at offset %d (%r...)" % (
+                        offset, data[offset:offset+32]
+                    ))
+                offset = end + 1
+            elif kind in ('d', 'l'):
+                stack.append([kind, 0])
+                parts.append('{' if kind == 'd' else '[')
+                offset += 1
+            else:
+                raise BencodeError("Unknown data type at offset %d (%r...)" % (
+                    offset, data[offset:offset+32]
+                ))
+
+        for part in parts:
+            buf.append(part)
+            buf_size += len(part)
+            if buf_size >= chunk_size:
+                yield ''.join(buf)
+                buf, buf_size = [], 0
+        if not stack:
+            if offset != size:
+                raise BencodeError("Trailing data at offset %d (%r...)" % (
+                    offset, data[offset:offset+32]
+                ))
+            if buf:
+                yield ''.join(buf)
+            break
+
+
+def bjson(data, char_encoding='utf-8', binary='hex', elide=()):
+    """ Convert bencoded data to a JSON string, see L{bjson_iter}.
+    """
+    return ''.join(bjson_iter(data, char_encoding, binary, elide))
+
+
+def main(args=None):
+    """ Convert bencoded files to JSON, see C{python -m pyrobase.bencode --help}.
+    """
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m pyrobase.bencode",
+                                     description="Convert bencoded files to JSON.")
+    parser.add_argument("files", nargs="+", metavar="FILE", help="bencoded file, or '-' for stdin")
+    parser.add_argument("-n", "--ndjson", action="store_true",
+                        help="write one line per file, instead of a JSON array of several files")
+    parser.add_argument("-p", "--with-path", action="store_true",
+                        help="wrap each document as {\"path\": ..., \"data\": ...}")
+    parser.add_argument("-b", "--binary", choices=("hex", "base64"), default="hex",
+                        help="format for non-text strings (default: %(default)s)")
+    parser.add_argument("-e", "--elide", action="append", default=[], metavar="KEY",
+                        help="skip the values of this dict key, e.g. 'pieces' (can be repeated)")
+    parser.add_argument("-E", "--encoding", default="utf-8",
+                        help="character encoding of text strings (default: %(default)s)")
+    parser.add_argument("-o", "--output", metavar="FILE", help="write to FILE instead of stdout")
+    args = parser.parse_args(args)
+
+    out = io.open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+
+    def write(text):
+        "Write JSON text, which is a native ASCII string on Python 2 that io files reject."
+        out.write(text_type(text) if PY2 and args.output else text)
+
+    array = len(args.files) > 1 and not args.ndjson
+    failed = written = 0
+    try:
+        if array:
+            write('[')
+        for filename in args.files:
+            try:
+                handle = open(filename, "rb") if filename != '-' else getattr(sys.stdin, "buffer", sys.stdin)
+                mapped = _mmap(handle)
+                try:
+                    # Convert all of it first, so a bad file cannot leave partial output
+                    text = ''.join(bjson_iter(handle.read() if mapped is None else mapped,
+                                              args.encoding, args.binary, args.elide))
+                finally:
+                    if mapped is not None:
+                        mapped.close()
+                    if handle is not getattr(sys.stdin, "buffer", sys.stdin):
+                        handle.close()
+            except (EnvironmentError, BencodeError) as exc:
+                failed += 1
+                sys.stderr.write("%s: %s\n" % (filename, exc))
+                continue
+
+            if array:
+                write(',\n' if written else '\n')
+            if args.with_path:
+                text = '{"path": %s, "data": %s}' % (json.dumps(filename), text)
+            write(text if array else text + '\n')
+            written += 1
+        if array:
+            write('\n]\n')
+    finally:
+        if args.output:
+            out.close()
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
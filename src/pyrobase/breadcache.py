@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+""" Persistent Cache of Decoded Bencode Files.
+
+    Kept apart from L{pyrobase.bencode}, so the codec itself does not
+    need C{sqlite3}, which is an optional part of the standard library.
+
+    Copyright (c) 2009-2020 The PyroScope Project <pyroscope.project@gmail.com>
+"""
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from __future__ import absolute_import
+
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+
+from pyrobase.bencode import bdecode
+
+
+class BreadCache(object):
+    """ Persistent cache of decoded files, so that warm starts skip parsing.
+
+        Decoded objects are pickled into a single SQLite database, and are
+        only used when path, size, and modification time of the file still
+        match (and the content hash, if C{verify} is set). When there are
+        more than C{max_entries}, the least recently used ones are evicted.
+        Changes are written on L{flush} and L{close}, or when leaving
+        a C{with} block.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT, atime REAL, data BLOB);
+        CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+    """
+
+    def __init__(self, filename, max_entries=10000, verify=False):
+        """ Open (or create) the cache database in C{filename}.
+        """
+        self.filename = filename
+        self.max_entries = max_entries
+        self.verify = verify
+        self.hits = self.misses = 0
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(self.SCHEMA)
+        self.size = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def bread(self, path):
+        """ Return the decoded content of the file at C{path}, from cache if possible.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        data = digest = None
+        if self.verify:
+            with open(path, "rb") as handle:
+                data = handle.read()
+            digest = hashlib.sha1(data).hexdigest()
+
+        row = self.db.execute("SELECT size, mtime, digest, data FROM entries WHERE path = ?",
+                              (path,)).fetchone()
+        if row and row[:2] == (stat.st_size, stat.st_mtime) and (not self.verify or row[2] == digest):
+            self.hits += 1
+            self.db.execute("UPDATE entries SET atime = ? WHERE path = ?", (time.time(), path))
+            return pickle.loads(bytes(row[3]))
+
+        self.misses += 1
+        if data is None:
+            with open(path, "rb") as handle:
+                data = handle.read()
+        obj = bdecode(data)
+        if not row:
+            self.size += 1
+        self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", (
+            path, stat.st_size, stat.st_mtime, digest, time.time(),
+            sqlite3.Binary(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)),
+        ))
+        if self.size > self.max_entries:
+            self.db.execute("DELETE FROM entries WHERE path IN"
+                            " (SELECT path FROM entries ORDER BY atime, rowid LIMIT ?)",
+                            (self.size - self.max_entries,))
+            self.size = self.max_entries
+        return obj
+
+    def flush(self):
+        """ Write pending changes to disk.
+        """
+        self.db.commit()
+
+    def close(self):
+        """ Write pending changes, and close the database.
+        """
+        if self.db:
+            self.db.commit()
+            self.db.close()
+            self.db = None
@@ -24,7 +24,11 @@ import os
 import time
 import pipes
 import socket
+import tempfile
+import threading
 import subprocess
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 try:
     from urllib.error import URLError
@@ -72,18 +76,42 @@ class LocalTransport(object):
             self.sock_addr = os.path.abspath(path)
 
 
-    def send(self, data):
-        """ Open transport, send data, and yield response chunks.
-        """
+    def _connect(self):
+        "Return a connected socket."
         sock = socket.socket(*self.sock_args)
         try:
             sock.connect(self.sock_addr)
         except socket.error as exc:
+            sock.close()
             raise socket.error("Can't connect to %r (%s)" % (self.url.geturl(), exc))
+        return sock
+
 
+    def request(self, parts):
+        """ Send request parts, and return the response payload and headers.
+
+            The parts are sent with scatter / gather I/O where available,
+            and the payload is received directly into a buffer sized by
+            its ``Content-Length``, so neither is copied around.
+
+            :param parts: List of bytestrings, starting with the SCGI header.
+            :return: Tuple of a bytearray payload and a headers dict.
+        """
+        sock = self._connect()
+        try:
+            _sendall(sock, parts)
+            return _receive(sock, self.CHUNK_SIZE)
+        finally:
+            sock.close()
+
+
+    def send(self, data):
+        """ Open transport, send data, and yield response chunks.
+        """
+        sock = self._connect()
         try:
             # Send request
-            sock.send(data)
+            sock.sendall(data)
 
             # Read response
             while True:
@@ -126,8 +154,14 @@ class SSHTransport(object):
             raise URLError("Bad location in URL %r (expected %r)" % (url.geturl(), reconstructed_netloc))
 
         self.cmd.extend(["--", ssh_netloc])
-        #self.cmd.extend(["/bin/nc", "-U", "--", clean_path])
-        self.cmd.extend(["socat", "-t5", "STDIO", "UNIX-CONNECT:" + clean_path])
+        self.cmd.extend(self._remote_cmd(clean_path))
+
+
+    def _remote_cmd(self, clean_path):
+        """ Return the remote command connecting to the (already quoted) socket path.
+        """
+        #return ["/bin/nc", "-U", "--", clean_path]
+        return ["socat", "-t5", "STDIO", "UNIX-CONNECT:" + clean_path]
 
 
     def send(self, data):
@@ -146,32 +180,210 @@ class SSHTransport(object):
             yield stdout
 
 
+# Remote side of ``SSHRelayTransport``, reads framed SCGI requests from stdin,
+# and writes each response as a netstring with a status prefix to stdout.
+# This must run on Python 2.7 and 3.x.
+RELAY_SCRIPT = r"""
+import os, sys, socket
+path = os.path.expanduser(sys.argv[1])
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+def read(size):
+    data = b''
+    while len(data) < size:
+        chunk = stdin.read(size - len(data))
+        if not chunk:
+            sys.exit(0)
+        data += chunk
+    return data
+while True:
+    head = read(1)
+    while not head.endswith(b':'):
+        head += read(1)
+    request = head + read(int(head[:-1]) + 1)
+    headers = request[len(head):-1].split(b'\0')
+    request += read(int(headers[headers.index(b'CONTENT_LENGTH') + 1]))
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            sock.sendall(request)
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            sock.close()
+        response = b'+' + b''.join(chunks)
+    except socket.error as exc:
+        response = b'-' + str(exc).encode('utf-8')
+    stdout.write(str(len(response)).encode('ascii') + b':' + response + b',')
+    stdout.flush()
+"""
+
+
+class SSHRelayTransport(SSHTransport):
+    """ Transport via a persistent SSH session to a UNIX domain socket.
+
+        Instead of one SSH process per request, a single session runs
+        a small Python relay on the remote host (see ``RELAY_SCRIPT``),
+        which carries all requests, so there's only one SSH handshake.
+        Requests are sent one at a time, and a broken session is
+        restarted on the next request.
+
+        ``transport_from_url`` returns one shared transport per URL
+        (see ``for_url``), so requests made by URL reuse its session,
+        which lasts until ``close`` is called or the process ends.
+    """
+
+    # Remote Python interpreter
+    PYTHON = "python3"
+
+    # Shared transports by class and URL, see ``for_url``
+    SHARED = {}
+    SHARED_LOCK = threading.Lock()
+
+
+    def __init__(self, url):
+        super(SSHRelayTransport, self).__init__(url)
+        self.cmd[1:1] = ["-o", "ServerAliveInterval=30"]
+        self.proc = None
+        self.stderr = None
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def for_url(cls, url):
+        """ Return the shared transport for a parsed URL, creating it on first use.
+        """
+        with cls.SHARED_LOCK:
+            key = (cls, url.geturl())
+            if key not in cls.SHARED:
+                cls.SHARED[key] = cls(url)
+            return cls.SHARED[key]
+
+
+    def _remote_cmd(self, clean_path):
+        """ Return the remote relay command for the (already quoted) socket path.
+        """
+        return [self.PYTHON, "-c", pipes.quote(RELAY_SCRIPT), clean_path]
+
+
+    def _start(self):
+        "Start the SSH session."
+        self.close()
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=self.stderr)
+        except OSError as exc:
+            raise URLError("Calling %r failed (%s)!" % (' '.join(self.cmd), exc))
+
+
+    def _failed(self, reason):
+        "Return an error for a failed session, with the end of its stderr output."
+        self.proc.wait()
+        self.stderr.seek(0)
+        errors = self.stderr.read()[-4096:].decode('utf-8', 'replace')
+        return URLError("Relay %r %s (RC=%s)!\n%s" % (
+            ' '.join(self.cmd[:-3]), reason, self.proc.returncode, errors,
+        ))
+
+
+    def _read(self, size):
+        "Read exactly ``size`` bytes from the relay."
+        data = self.proc.stdout.read(size)
+        if len(data) != size:
+            raise self._failed("failed")
+        return data
+
+
+    def close(self):
+        """ End the SSH session, if there is one.
+        """
+        if self.proc is not None:
+            proc, self.proc = self.proc, None
+            try:
+                proc.stdin.close()
+            except EnvironmentError:
+                pass
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        if self.stderr is not None:
+            self.stderr.close()
+            self.stderr = None
+
+
+    def send(self, data):
+        """ Send data over the SSH session (started when needed), and yield the response.
+        """
+        with self.lock:
+            for attempt in range(2):
+                if self.proc is None or self.proc.poll() is not None:
+                    self._start()
+                try:
+                    self.proc.stdin.write(data)
+                    self.proc.stdin.flush()
+                except EnvironmentError:
+                    # The session died while idle, so the request was not received
+                    if attempt:
+                        raise self._failed("is not accepting requests")
+                    self.close()
+                else:
+                    break
+
+            try:
+                head = self._read(1)
+                while not head.endswith(b':'):
+                    head += self._read(1)
+                response = self._read(int(head[:-1]) + 1)[:-1]
+            except (EnvironmentError, ValueError, URLError):
+                self.close()
+                raise
+
+        if response[:1] != b'+':
+            raise socket.error("Can't connect to %r (%s)" % (
+                self.url.geturl(), response[1:].decode('utf-8', 'replace')))
+        yield response[1:]
+
+
 TRANSPORTS = {
     "scgi": LocalTransport,
     "scgi+ssh": SSHTransport,
+    "scgi+ssh+relay": SSHRelayTransport,
 }
 
 # Register our schemes to be parsed as having a netloc
 urlparse.uses_netloc.extend(TRANSPORTS.keys())
 
 
-def transport_from_url(url):
+def transport_from_url(url, transports=None):
     """ Create a transport for the given URL.
+
+        Transport classes with a ``for_url`` class method return a
+        shared instance from it, instead of a new one.
+
+        :param transports: Mapping of URL schemes to transport classes,
+            defaults to ``TRANSPORTS``.
     """
+    transports = transports or TRANSPORTS
     if '/' not in url and ':' in url and url.rsplit(':')[-1].isdigit():
         url = 'scgi://' + url
     url = urlparse.urlsplit(url, scheme="scgi", allow_fragments=False)  # pylint: disable=redundant-keyword-arg
 
     try:
-        transport = TRANSPORTS[url.scheme.lower()]
+        transport = transports[url.scheme.lower()]
     except KeyError:
         if not any((url.netloc, url.query)) and url.path.isdigit():
             # Support simplified "domain:port" URLs
-            return transport_from_url("scgi://%s:%s" % (url.scheme, url.path))
+            return transport_from_url("scgi://%s:%s" % (url.scheme, url.path), transports)
         else:
             raise URLError("Unsupported scheme in URL %r" % url.geturl())
     else:
-        return transport(url)
+        return getattr(transport, "for_url", transport)(url)
 
 
 #
@@ -189,13 +401,84 @@ def _encode_headers(headers):
     return b''.join([b'%s\0%s\0' % (k.encode('ascii'), v.encode('ascii')) for k, v in headers])
 
 
-def _encode_payload(data, headers=None):
-    "Wrap data in an SCGI request."
-    prolog = b"CONTENT_LENGTH\0%d\0SCGI\x001\0" % len(data)
+def _encode_header(size, headers=None):
+    "Make the SCGI request header for a body of the given size."
+    prolog = b"CONTENT_LENGTH\0%d\0SCGI\x001\0" % size
     if headers:
         prolog += _encode_headers(headers)
 
-    return _encode_netstring(prolog) + data
+    return _encode_netstring(prolog)
+
+
+def _encode_payload(data, headers=None):
+    "Wrap data in an SCGI request."
+    return _encode_header(len(data), headers) + data
+
+
+# Max. number of buffers passed to a single "sendmsg" call (below IOV_MAX)
+SENDMSG_MAX_PARTS = 512
+
+
+def _sendall(sock, parts):
+    "Send all parts, with a single system call per batch of buffers where possible."
+    sendmsg = getattr(sock, "sendmsg", None)
+    if sendmsg is None:
+        for part in parts:
+            sock.sendall(part)
+        return
+
+    views = [memoryview(i) for i in parts if len(i)]
+    views.reverse()  # consume from the end of the list
+    while views:
+        sent = sendmsg(views[:-SENDMSG_MAX_PARTS - 1:-1])
+        while views and sent >= len(views[-1]):
+            sent -= len(views.pop())
+        if sent:
+            views[-1] = views[-1][sent:]
+
+
+def _receive(sock, chunk_size):
+    """
+    Receive an SCGI response, and return its payload and headers.
+
+    The headers are parsed as soon as they're complete, and when there is
+    a ``Content-Length``, the rest of the payload is received in place.
+
+    :return: A tuple of a bytearray payload and a dictionary of string keys/values
+    """
+    data = bytearray()
+    while True:
+        chunk = sock.recv(chunk_size)
+        if not chunk:
+            raise SCGIException("No header delimiter in SCGI response of length %d" % len(data))
+        data += chunk
+        end = data.find(b"\r\n\r\n")
+        if end >= 0:
+            break
+    headers = _parse_headers(bytes(data[:end]))
+    del data[:end + 4]
+
+    clen = headers.get("Content-Length")
+    if clen is None:
+        while chunk:
+            chunk = sock.recv(chunk_size)
+            data += chunk
+        return data, headers
+
+    clen = int(clen)
+    if len(data) > clen:
+        raise SCGIException("SCGI response is longer than its Content-Length (%d > %d)" % (len(data), clen))
+    payload = bytearray(clen)
+    payload[:len(data)] = data
+    view = memoryview(payload)
+    pos = len(data)
+    while pos < clen:
+        count = sock.recv_into(view[pos:])
+        if not count:
+            raise SCGIException("SCGI response truncated at %d of %d bytes" % (pos, clen))
+        pos += count
+
+    return payload, headers
 
 
 def _parse_headers(headers):
@@ -268,13 +551,32 @@ class SCGIRequest(object):
     def send(self, data):
         """ Send data over scgi to URL and get response.
 
-        :param data: The bytestring to send
+        :param data: The bytestring to send, or a list or tuple of bytestrings
         :type data: bytes
         :return: Response bytestring
         """
+        return bytes(self.send_buffer(data))
+
+
+    def send_buffer(self, data):
+        """ Send data over scgi to URL and get response, without copying it.
+
+        Transports with a ``request`` method get the data as a list of
+        parts, so they can send it without joining it first, and return
+        the parsed response, which was received in place.
+
+        :param data: The bytestring to send, or a list or tuple of bytestrings
+        :type data: bytes
+        :return: Response bytearray, or bytestring for other transports
+        """
+        parts = list(data) if isinstance(data, (list, tuple)) else [data]
+        header = _encode_header(sum(len(i) for i in parts))
         start = time.time()
         try:
-            scgi_resp = b''.join(self.transport.send(_encode_payload(data)))
+            if hasattr(self.transport, "request"):
+                resp, self.resp_headers = self.transport.request([header] + parts)
+                return resp
+            scgi_resp = b''.join(self.transport.send(header + b''.join(parts)))
         finally:
             self.latency = time.time() - start
 
@@ -294,15 +596,239 @@ def scgi_request(url, methodname, *params, **kw):
         :return: XMLRPC string response, or the equivalent Python data.
     """
     xmlreq = xmlrpclib.dumps(params, methodname)
-    xmlresp = SCGIRequest(url).send(xmlreq.encode()).decode()
+    xmlresp = SCGIRequest(url).send_buffer(xmlreq.encode()).decode()
 
     if kw.get("deserialize", True):
-        # This fixes a bug with the Python xmlrpclib module
-        # (has no handler for <i8> in some versions)
-        xmlresp = xmlresp.replace("<i8>", "<i4>").replace("</i8>", "</i4>")
-
         # Return deserialized data
-        return xmlrpclib.loads(xmlresp)[0][0]
+        return _xmlrpc_loads(xmlresp)
     else:
         # Return raw XML
         return xmlresp
+
+
+def _xmlrpc_loads(xmlresp):
+    "Deserialize a XMLRPC response, and return its value."
+    # This fixes a bug with the Python xmlrpclib module
+    # (has no handler for <i8> in some versions)
+    xmlresp = xmlresp.replace("<i8>", "<i4>").replace("</i8>", "</i4>")
+
+    return xmlrpclib.loads(xmlresp)[0][0]
+
+
+# Marker for a call in a batch without a result yet
+_PENDING = object()
+
+
+class _BaseMulticallBatch(object):
+    """ Calls collected for ``system.multicall`` requests, see :class:`MulticallBatch`.
+    """
+
+    # Request framing around the serialized calls
+    HEAD = b"<?xml version='1.0'?>\n<methodCall>\n<methodName>system.multicall</methodName>\n" \
+           b"<params>\n<param>\n<value><array><data>\n"
+    TAIL = b"</data></array></value>\n</param>\n</params>\n</methodCall>\n"
+
+    # Parts of a serialized single-value parameter list, around the value
+    PARAM_PREFIX = "<params>\n<param>\n"
+    PARAM_SUFFIX = "</param>\n</params>\n"
+
+
+    def __init__(self, url_or_transport, max_calls=1000, max_bytes=1024**2):
+        """ Create an empty batch.
+
+            :param url_or_transport: Endpoint URL, or a transport object.
+            :param max_calls: Max. number of calls per request.
+            :param max_bytes: Max. size of a request body (a single bigger call is still sent).
+        """
+        self.request = SCGIRequest(url_or_transport)
+        self.max_calls = max_calls
+        self.max_bytes = max_bytes
+        self.calls = []
+        self._results = []  # results by call index, or _PENDING
+        self.requests = 0
+        self.latency = 0.0
+
+
+    def __len__(self):
+        return len(self.calls)
+
+
+    def add(self, methodname, *params):
+        """ Add a call to the batch.
+
+            :param methodname: XMLRPC method name.
+            :param params: Tuple of simple python objects.
+            :return: Index of the call's result.
+            :raises SCGIException: ``xmlrpclib`` produced unexpected XML.
+        """
+        xml = xmlrpclib.dumps(({"methodName": methodname, "params": list(params)},))
+        if not (xml.startswith(self.PARAM_PREFIX) and xml.endswith(self.PARAM_SUFFIX)):
+            raise SCGIException("Unexpected XMLRPC parameter framing in %r" % xml[:100])
+        xml = xml[len(self.PARAM_PREFIX):-len(self.PARAM_SUFFIX)]
+        self.calls.append(xml if isinstance(xml, bytes) else xml.encode('utf-8'))
+        self._results.append(_PENDING)
+        return len(self.calls) - 1
+
+
+    def _batches(self):
+        "Split the calls without a result into request bodies, as pairs of the first call's index and the calls."
+        chunk, size = [], len(self.HEAD) + len(self.TAIL)
+        for idx, call in enumerate(self.calls):
+            done = self._results[idx] is not _PENDING
+            if chunk and (done or len(chunk) >= self.max_calls or size + len(call) > self.max_bytes):
+                yield idx - len(chunk), chunk
+                chunk, size = [], len(self.HEAD) + len(self.TAIL)
+            if not done:
+                chunk.append(call)
+                size += len(call)
+        if chunk:
+            yield len(self.calls) - len(chunk), chunk
+
+
+    def _parse_results(self, xmlresp, count):
+        "Return the results of a ``system.multicall`` response, and update the stats."
+        self.requests += 1
+        self.latency += self.request.latency
+
+        values = _xmlrpc_loads(xmlresp.decode('utf-8'))
+        if len(values) != count:
+            raise SCGIException("Got %d results for %d calls in system.multicall" % (len(values), count))
+        return [xmlrpclib.Fault(value.get("faultCode"), value.get("faultString"))
+                if isinstance(value, dict) else value[0]
+                for value in values]
+
+
+    def _finish(self, raise_faults):
+        "Empty the batch, and return all results, or raise the first fault if requested."
+        results = self._results
+        self.calls, self._results = [], []
+        if raise_faults:
+            for result in results:
+                if isinstance(result, xmlrpclib.Fault):
+                    raise result
+        return results
+
+
+class MulticallBatch(_BaseMulticallBatch):
+    """ Collect XMLRPC calls, and send them as a few ``system.multicall`` requests.
+
+        Calls are split into several requests when a batch gets more than
+        ``max_calls`` calls, or its XML gets bigger than ``max_bytes``.
+        Each call is serialized once when it's added, and the request
+        bodies are built from those fragments.
+
+        When a request fails, ``run`` passes on the error, and the batch
+        keeps the calls that got no result yet (including those of the
+        failed request, which might have been executed anyway). Calling
+        ``run`` again sends only those, and returns all results.
+
+        Example::
+
+            batch = MulticallBatch('scgi:///tmp/rtorrent.sock')
+            for infohash in hashes:
+                batch.add('d.stop', infohash)
+            results = batch.run()
+    """
+
+    def run(self, raise_faults=False):
+        """ Send all collected calls, and return their results.
+
+            Failed calls are returned as ``xmlrpclib.Fault`` objects,
+            at the position of the call. The batch is empty afterwards,
+            unless a request fails (see above).
+
+            :param raise_faults: Raise the first fault instead, after all
+                calls are done?
+            :return: List of results, in the order the calls were added.
+        """
+        for start, chunk in self._batches():
+            xmlresp = self.request.send_buffer([self.HEAD] + chunk + [self.TAIL])
+            self._results[start:start + len(chunk)] = self._parse_results(xmlresp, len(chunk))
+
+        return self._finish(raise_faults)
+
+
+class ScgiPool(object):
+    """ Run many XMLRPC calls concurrently, on a pool of threads.
+
+        SCGI needs a connection per request, so keeping several requests
+        in flight is the way to raise throughput. At most ``max_inflight``
+        calls run at the same time, and results are returned in order.
+
+        Example::
+
+            with ScgiPool('scgi:///tmp/rtorrent.sock', max_inflight=8) as pool:
+                names = list(pool.map('d.name', hashes))
+                print(max(pool.latencies))
+    """
+
+    def __init__(self, url_or_transport, max_inflight=4):
+        """ Create a pool.
+
+            :param url_or_transport: Endpoint URL, or a transport object.
+            :param max_inflight: Max. number of concurrent calls.
+        """
+        self.transport = SCGIRequest(url_or_transport).transport
+        self.max_inflight = max_inflight
+        self.latencies = []
+        self._pool = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *_):
+        self.close()
+
+
+    def close(self):
+        """ Stop the pool's threads.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+    def _call(self, methodname, params, deserialize):
+        "Perform a single call (in a worker thread), and return its result and latency."
+        request = SCGIRequest(self.transport)
+        xmlresp = request.send_buffer(xmlrpclib.dumps(params, methodname).encode()).decode()
+        if not deserialize:
+            return xmlresp, request.latency
+        try:
+            return _xmlrpc_loads(xmlresp), request.latency
+        except xmlrpclib.Fault as exc:
+            return exc, request.latency
+
+
+    def map(self, methodname, params_iter, deserialize=True):
+        """ Call ``methodname`` once per item of ``params_iter``, and yield the results in order.
+
+            Faults are yielded as ``xmlrpclib.Fault`` objects, other errors
+            are raised. The latency of each call is added to ``latencies``,
+            which is reset when ``map`` starts.
+
+            :param methodname: XMLRPC method name.
+            :param params_iter: Iterable of parameter tuples; other items
+                are passed as a single parameter.
+            :param deserialize: Parse XML results?
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_inflight)
+        self.latencies = []
+
+        pending = deque()
+        for params in params_iter:
+            if not isinstance(params, tuple):
+                params = (params,)
+            pending.append(self._pool.apply_async(self._call, (methodname, params, deserialize)))
+            # Queue a few more calls than can run, so the threads never idle
+            if len(pending) > 2 * self.max_inflight:
+                result, latency = pending.popleft().get()
+                self.latencies.append(latency)
+                yield result
+        while pending:
+            result, latency = pending.popleft().get()
+            self.latencies.append(latency)
+            yield result
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=too-few-public-methods
+""" Asynchronous XMLRPC via SCGI client, based on asyncio.
+
+    This module needs Python 3.5 or later, and mirrors the API of
+    :mod:`pyrobase.io.xmlrpc2scgi` with coroutines, so that many
+    requests can be in flight on one event loop::
+
+        results = await asyncio.gather(*[
+            scgi_request(url, 'd.name', infohash) for infohash in hashes
+        ])
+
+    Copyright (c) 2011-2020 The PyroScope Project <pyroscope.project@gmail.com>
+"""
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import os
+import time
+import socket
+import asyncio
+from urllib.error import URLError
+from xmlrpc import client as xmlrpclib
+
+from pyrobase.io import xmlrpc2scgi
+from pyrobase.io.xmlrpc2scgi import (  # pylint: disable=unused-import
+    SCGIException, ERRORS, _encode_payload, _parse_response, _xmlrpc_loads,
+)
+
+
+#
+# SCGI transports
+#
+
+class AsyncLocalTransport(object):
+    """ Transport via TCP or a UNIX domain socket, using asyncio streams.
+
+        Unlike :class:`pyrobase.io.xmlrpc2scgi.LocalTransport`, host names
+        are not resolved up front, but by the event loop on each connect,
+        so creating a transport never blocks.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+        if url.netloc:
+            # TCP socket
+            self.sock_args = (socket.AF_INET, socket.SOCK_STREAM)
+            self.sock_addr = (url.hostname, url.port)
+        else:
+            # UNIX domain socket
+            self.sock_args = (socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock_addr = os.path.abspath(os.path.expanduser(url.path))
+
+
+    async def send(self, data):
+        """ Open a connection, send data, and return the response.
+        """
+        try:
+            if self.sock_args[0] == socket.AF_UNIX:
+                reader, writer = await asyncio.open_unix_connection(self.sock_addr)
+            else:
+                reader, writer = await asyncio.open_connection(*self.sock_addr, family=self.sock_args[0])
+        except (OSError, socket.error) as exc:
+            raise socket.error("Can't connect to %r (%s)" % (self.url.geturl(), exc))
+
+        try:
+            writer.write(data)
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+            if hasattr(writer, "wait_closed"):  # Python 3.7+
+                await writer.wait_closed()
+
+
+class AsyncSSHTransport(object):
+    """ Transport via SSH to a UNIX domain socket, using an asyncio subprocess.
+
+        The command is built like for :class:`pyrobase.io.xmlrpc2scgi.SSHTransport`.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.cmd = xmlrpc2scgi.SSHTransport(url).cmd
+
+
+    async def send(self, data):
+        """ Run the SSH command, send data, and return the response.
+        """
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self.cmd, stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except OSError as exc:
+            raise URLError("Calling %r failed (%s)!" % (' '.join(self.cmd), exc))
+
+        stdout, stderr = await proc.communicate(data)
+        if proc.returncode:
+            raise URLError("Calling %r failed with RC=%d!\n%s" % (
+               ' '.join(self.cmd), proc.returncode, stderr,
+            ))
+        return stdout
+
+
+TRANSPORTS = {
+    "scgi": AsyncLocalTransport,
+    "scgi+ssh": AsyncSSHTransport,
+}
+
+
+def transport_from_url(url):
+    """ Create an asynchronous transport for the given URL.
+    """
+    return xmlrpc2scgi.transport_from_url(url, TRANSPORTS)
+
+
+#
+# SCGI request handling
+#
+class AsyncSCGIRequest(object):
+    """ Send a SCGI request from a coroutine.
+
+        ``await AsyncSCGIRequest('scgi:///tmp/rtorrent.sock').send(data)``
+    """
+
+    def __init__(self, url_or_transport, timeout=None):
+        """ Create a request.
+
+            :param url_or_transport: Endpoint URL, or an asynchronous transport object.
+            :param timeout: Max. seconds for a request, or ``None``.
+        """
+        try:
+            self.transport = transport_from_url(url_or_transport + "")
+        except TypeError:
+            self.transport = url_or_transport
+        self.timeout = timeout
+        self.resp_headers = {}
+        self.latency = 0.0
+
+
+    async def send(self, data):
+        """ Send data over scgi to URL and get response.
+
+        :param data: The bytestring to send
+        :type data: bytes
+        :return: Response bytestring
+        :raises asyncio.TimeoutError: The request took longer than ``timeout``.
+        """
+        start = time.time()
+        try:
+            scgi_resp = await asyncio.wait_for(self.transport.send(_encode_payload(data)), self.timeout)
+        finally:
+            self.latency = time.time() - start
+
+        resp, self.resp_headers = _parse_response(scgi_resp)
+        return resp
+
+
+async def scgi_request(url, methodname, *params, **kw):
+    """ Send a XMLRPC request over SCGI to the given URL, from a coroutine.
+
+        :param url: Endpoint URL, or an asynchronous transport object.
+        :param methodname: XMLRPC method name.
+        :param params: Tuple of simple python objects.
+        :keyword deserialize: Parse XML result? (default is True)
+        :keyword timeout: Max. seconds for the request (default is None).
+        :return: XMLRPC string response, or the equivalent Python data.
+    """
+    xmlreq = xmlrpclib.dumps(params, methodname)
+    xmlresp = await AsyncSCGIRequest(url, timeout=kw.get("timeout")).send(xmlreq.encode())
+    xmlresp = xmlresp.decode()
+
+    if kw.get("deserialize", True):
+        return _xmlrpc_loads(xmlresp)
+    else:
+        return xmlresp
+
+
+class AsyncMulticallBatch(xmlrpc2scgi._BaseMulticallBatch):  # pylint: disable=protected-access
+    """ Collect XMLRPC calls, and send them as ``system.multicall`` requests from a coroutine.
+
+        See :class:`pyrobase.io.xmlrpc2scgi.MulticallBatch`; the requests of
+        a batch are sent concurrently.
+    """
+
+    def __init__(self, url_or_transport, max_calls=1000, max_bytes=1024**2, timeout=None):
+        super(AsyncMulticallBatch, self).__init__(
+            AsyncSCGIRequest(url_or_transport, timeout).transport, max_calls, max_bytes)
+        self.timeout = timeout
+
+
+    async def _send(self, chunk):
+        "Send one request of the batch, and return its results."
+        request = AsyncSCGIRequest(self.request.transport, self.timeout)
+        xmlresp = await request.send(self.HEAD + b''.join(chunk) + self.TAIL)
+        self.request = request  # for the latency stats
+        return self._parse_results(xmlresp, len(chunk))
+
+
+    async def run(self, raise_faults=False):
+        """ Send all collected calls, and return their results.
+
+            See :meth:`pyrobase.io.xmlrpc2scgi.MulticallBatch.run`; when requests
+            fail, the first error is raised after all of them are done.
+        """
+        chunks = list(self._batches())
+        outcomes = await asyncio.gather(*[self._send(chunk) for _, chunk in chunks],
+                                        return_exceptions=True)
+        for (start, chunk), outcome in zip(chunks, outcomes):
+            if not isinstance(outcome, BaseException):
+                self._results[start:start + len(chunk)] = outcome
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+
+        return self._finish(raise_faults)
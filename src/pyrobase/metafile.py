@@ -0,0 +1,811 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=too-few-public-methods
+""" Metafile (torrent) Support.
+
+    Bulk operations on metafiles, built on L{pyrobase.bencode}.
+
+    Copyright (c) 2009-2020 The PyroScope Project <pyroscope.project@gmail.com>
+"""
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import time
+import bisect
+import hashlib
+import multiprocessing
+from array import array
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    from collections.abc import Sequence
+except ImportError:  # Python 2
+    from collections import Sequence
+
+from six import PY2, binary_type, integer_types, text_type
+from six.moves import intern  # pylint: disable=redefined-builtin
+
+from pyrobase import bencode
+
+
+# Array type for file lengths: signed 64-bit, or a C long on Python 2 which lacks 'q'
+LENGTH_TYPECODE = 'l' if PY2 else 'q'
+
+# Key paths needed to build a L{TorrentSummary}
+SUMMARY_FIELDS = ("announce", "info/name", "info/length", "info/files/*/length")
+
+
+class TorrentSummary(namedtuple("TorrentSummary",
+        "path filesize mtime info_hash name size files announce fields error")):
+    """ Compact summary record of a metafile.
+
+        C{filesize} and C{mtime} are the metafile's own stat values,
+        C{size} and C{files} describe the content. C{fields} holds the
+        values of extra key paths requested from L{scan_torrents}, and
+        C{error} is set instead of the other values when the file
+        cannot be read or decoded.
+    """
+    __slots__ = ()
+
+
+def _get_path(obj, path):
+    """ Return the value at the key path in C{obj}, or C{None}.
+    """
+    for key in path.strip('/').split('/'):
+        if isinstance(obj, list) and key.isdigit():
+            obj = obj[int(key)] if int(key) < len(obj) else None
+        elif isinstance(obj, dict):
+            obj = obj.get(key)
+        else:
+            obj = None
+        if obj is None:
+            break
+    return obj
+
+
+def _check_summary_fields(meta):
+    """ Check the types of the values a L{TorrentSummary} is built from.
+
+        @raise ValueError: Bad metafile structure.
+    """
+    def check_length(value, what):
+        "Check for a valid length."
+        if not isinstance(value, integer_types) or value < 0:
+            raise ValueError("Bad %s length %r" % (what, value))
+
+    if not isinstance(meta, dict):
+        raise ValueError("Metafile is not a dict")
+    if not isinstance(meta.get("announce", ""), (text_type, binary_type)):
+        raise ValueError("Bad announce URL %r" % (meta["announce"],))
+    info = meta.get("info")
+    if not isinstance(info, dict):
+        raise ValueError("Bad or missing info dict")
+    if not isinstance(info.get("name"), (text_type, binary_type)):
+        raise ValueError("Bad or missing name %r" % (info.get("name"),))
+
+    if "files" in info:
+        # non-dict entries are already dropped by the projection
+        if not isinstance(info["files"], list) or not info["files"]:
+            raise ValueError("Bad or empty file list")
+        for entry in info["files"]:
+            if not isinstance(entry, dict):
+                raise ValueError("Bad file list entry %r" % (entry,))
+            check_length(entry.get("length"), "file")
+    else:
+        check_length(info.get("length"), "content")
+
+
+def summarize(path, filesize=None, mtime=None, fields=()):
+    """ Read the metafile at C{path}, and return its L{TorrentSummary}.
+
+        Unreadable files, invalid data, and metafiles with missing or
+        badly typed fields get a record with C{error} set.
+    """
+    try:
+        if filesize is None or mtime is None:
+            stat = os.stat(path)
+            filesize, mtime = stat.st_size, stat.st_mtime
+        with open(path, "rb") as handle:
+            data = handle.read()
+
+        meta = bencode.bdecode(data, select=SUMMARY_FIELDS + tuple(fields), raw_fields=["pieces"])
+        _check_summary_fields(meta)
+        info = meta["info"]
+        files = info.get("files")
+        size = sum(i["length"] for i in files) if files is not None else info["length"]
+
+        return TorrentSummary(
+            path, filesize, mtime, bencode.info_hash(data), info.get("name"), size,
+            len(files) if files is not None else 1, meta.get("announce"),
+            tuple(_get_path(meta, i) for i in fields), None,
+        )
+    except (EnvironmentError, KeyError, ValueError) as exc:
+        return TorrentSummary(path, filesize, mtime, None, None, None, None, None, (), str(exc))
+
+
+def _summarize_chunk(args):
+    """ Summarize a chunk of C{(path, filesize, mtime)} tuples (in a worker process).
+    """
+    chunk, fields = args
+    return [summarize(path, filesize, mtime, fields) for path, filesize, mtime in chunk]
+
+
+def scan_torrents(paths, fields=(), workers=None, chunk_size=64, previous=None):
+    """ Summarize many metafiles in parallel, yielding L{TorrentSummary} records in order.
+
+        Paths are handed to a pool of C{workers} processes (defaulting to
+        the number of CPUs, and C{1} scans in-process) in chunks of
+        C{chunk_size}, to keep the IPC overhead low.
+
+        @param fields: Extra key paths to add to each record, e.g. C{"info/source"}.
+        @param previous: Mapping of paths to records of an earlier scan with the
+            same C{fields}; files with unchanged size and mtime are not read
+            again, so a rescan only costs a C{stat} call for unchanged files.
+    """
+    fields = tuple(fields)
+    previous = previous or {}
+
+    def jobs():
+        "Stat all files, and yield the ones needing a scan, or a known record."
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except EnvironmentError as exc:
+                yield TorrentSummary(path, None, None, None, None, None, None, None, (), str(exc))
+                continue
+
+            known = previous.get(path)
+            if (known is not None and known.error is None and len(known.fields) == len(fields)
+                    and (known.filesize, known.mtime) == (stat.st_size, stat.st_mtime)):
+                yield known
+            else:
+                yield (path, stat.st_size, stat.st_mtime)
+
+    def chunks():
+        "Group jobs into chunks, passing known records as single items."
+        chunk = []
+        for job in jobs():
+            if isinstance(job, TorrentSummary):
+                if chunk:
+                    yield chunk
+                    chunk = []
+                yield job
+            else:
+                chunk.append(job)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        for chunk in chunks():
+            if isinstance(chunk, TorrentSummary):
+                yield chunk
+            else:
+                for record in _summarize_chunk((chunk, fields)):
+                    yield record
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = []
+        for chunk in chunks():
+            if isinstance(chunk, TorrentSummary):
+                pending.append(chunk)
+            else:
+                pending.append(pool.apply_async(_summarize_chunk, ((chunk, fields),)))
+            # Limit the amount of pending work, and hand out finished records
+            while pending and (len(pending) > 4 * workers or isinstance(pending[0], TorrentSummary)
+                               or pending[0].ready()):
+                for record in _results(pending.pop(0)):
+                    yield record
+        for item in pending:
+            for record in _results(item):
+                yield record
+    finally:
+        pool.terminate()
+
+
+def _results(item):
+    """ Return the records of a pending scan item.
+    """
+    return [item] if isinstance(item, TorrentSummary) else item.get()
+
+
+class PieceHashes(Sequence):
+    """ Read-only sequence of the piece hashes in a C{pieces} string.
+
+        The hashes stay in the original blob, items are sliced out on access.
+    """
+    __slots__ = ('data', 'stride')
+
+    def __init__(self, data, stride=20):
+        """ Wrap the raw C{pieces} data (bytes, or a lazy string).
+
+            @param stride: Hash size, C{20} for SHA1 (v1), C{32} for SHA256 (v2).
+            @raise ValueError: Length of C{data} is not a multiple of C{stride}.
+        """
+        if hasattr(data, "tobytes"):
+            data = data.tobytes()
+        if len(data) % stride:
+            raise ValueError("Length of pieces (%d) is not a multiple of %d" % (len(data), stride))
+        self.data = data
+        self.stride = stride
+
+    def __len__(self):
+        return len(self.data) // self.stride
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("piece index out of range")
+        return self.data[idx * self.stride:(idx + 1) * self.stride]
+
+    def __eq__(self, other):
+        if isinstance(other, PieceHashes):
+            return (self.stride, self.data) == (other.stride, other.data)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<%s %d x %d bytes>" % (self.__class__.__name__, len(self), self.stride)
+
+
+class FileEntry(object):
+    """ A single file in a L{FileList}, created on access.
+    """
+    __slots__ = ('path', 'length', 'offset')
+
+    def __init__(self, path, length, offset):
+        self.path = path
+        self.length = length
+        self.offset = offset
+
+    def __eq__(self, other):
+        if isinstance(other, FileEntry):
+            return (self.path, self.length, self.offset) == (other.path, other.length, other.offset)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "FileEntry(%r, %d, %d)" % ('/'.join(self.path), self.length, self.offset)
+
+
+def _intern_name(name):
+    """ Intern a path component, if it is a native string.
+    """
+    return intern(name) if type(name) is str else name # pylint: disable=unidiomatic-typecheck
+
+
+class FileList(Sequence):
+    """ Compact read-only list of the files in a metafile.
+
+        Lengths are held in an C{array(LENGTH_TYPECODE)}, and paths in a table of
+        tuples with interned components, instead of one dict per file.
+        L{FileEntry} items include the offset of a file in the torrent's
+        content, which is handy for mapping pieces to files. The indexes
+        of BEP 47 padding files are kept in C{pads}.
+    """
+    __slots__ = ('lengths', 'paths', 'pads', '_offsets')
+
+    def __init__(self, files):
+        """ Build the list from the decoded C{files} list of a multi-file metafile,
+            or the C{(path, length)} pairs of other sources.
+        """
+        self.lengths = array(LENGTH_TYPECODE)
+        paths = []
+        pads = []
+        dirs = {}
+        for item in files:
+            if isinstance(item, dict):
+                path, length = item["path"], item["length"]
+                if 'p' in item.get("attr", ""):
+                    pads.append(len(paths))
+            else:
+                path, length = item
+            path = tuple(_intern_name(i) for i in path)
+            # Share the directory part between files in the same place
+            path = dirs.setdefault(path[:-1], path[:-1]) + path[-1:]
+            paths.append(path)
+            self.lengths.append(length)
+        self.paths = tuple(paths)
+        self.pads = frozenset(pads)
+        self._offsets = None
+
+    @property
+    def size(self):
+        """ Total size of all files.
+        """
+        return sum(self.lengths)
+
+    def offsets(self):
+        """ Return the start offsets of all files, as an C{array(LENGTH_TYPECODE)}.
+        """
+        if self._offsets is None:
+            offsets, total = array(LENGTH_TYPECODE), 0
+            for length in self.lengths:
+                offsets.append(total)
+                total += length
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        return FileEntry(self.paths[idx], self.lengths[idx], self.offsets()[idx])
+
+
+# Record types for decoding metafiles with C{bdecode(data, schema=MetafileRecord)}
+FileRecord = bencode.record_type("FileRecord", [
+    ("length", int), ("path", [text_type]), ("attr", text_type), ("md5sum", text_type),
+])
+InfoRecord = bencode.record_type("InfoRecord", [
+    ("name", text_type), ("piece length", int), ("pieces", binary_type), ("length", int),
+    ("files", [FileRecord]), ("private", int), ("source", text_type),
+    ("meta version", int), ("file tree", dict),
+])
+MetafileRecord = bencode.record_type("MetafileRecord", [
+    ("announce", text_type), ("announce-list", [list]), ("comment", text_type),
+    ("created by", text_type), ("creation date", int), ("encoding", text_type),
+    ("info", InfoRecord), ("piece layers", dict),
+])
+
+# Record types for rtorrent session files ("*.torrent.rtorrent"), and their resume data
+ResumeFileRecord = bencode.record_type("ResumeFileRecord", [
+    ("completed", int), ("mtime", int), ("priority", int),
+])
+ResumeRecord = bencode.record_type("ResumeRecord", [
+    # "bitfield" is a count when all pieces are done, else a bit string
+    ("bitfield", object), ("files", [ResumeFileRecord]), ("peers4", binary_type),
+    ("peers6", binary_type), ("trackers", dict), ("uncertain_pieces.timestamp", int),
+])
+SessionRecord = bencode.record_type("SessionRecord", [
+    ("chunks_done", int), ("chunks_wanted", int), ("complete", int),
+    ("custom1", text_type), ("custom2", text_type), ("custom3", text_type),
+    ("custom4", text_type), ("custom5", text_type), ("custom", dict),
+    ("directory", text_type), ("hashing", int), ("ignore_commands", int), ("key", int),
+    ("priority", int), ("state", int), ("state_changed", int), ("state_counter", int),
+    ("throttle_name", text_type), ("tied_to_file", text_type),
+    ("timestamp.finished", int), ("timestamp.started", int), ("total_uploaded", int),
+    ("views", [text_type]), ("libtorrent_resume", ResumeRecord),
+])
+
+
+class CompactTorrent(object):
+    """ Memory-efficient model of the essential parts of a metafile.
+
+        Use L{compact} or L{load_compact} to create instances. Single-file
+        torrents get a one-item C{files} list with the torrent name as path,
+        and C{multi} set to C{False}.
+    """
+    __slots__ = ('info_hash', 'name', 'announce', 'piece_length', 'pieces', 'files', 'multi')
+
+    def __init__(self, info_hash, name, announce, piece_length, pieces, files, # pylint: disable=too-many-arguments
+                 multi=True):
+        self.info_hash = info_hash
+        self.name = name
+        self.announce = announce
+        self.piece_length = piece_length
+        self.pieces = pieces
+        self.files = files
+        self.multi = multi
+
+    @property
+    def size(self):
+        """ Total size of the content.
+        """
+        return self.files.size
+
+    def piece_files(self, idx):
+        """ Return the L{FileEntry} items that (partially) hold piece C{idx}.
+        """
+        start = idx * self.piece_length
+        end = start + self.piece_length
+        return [i for i in self.files if i.offset < end and i.offset + i.length > start]
+
+    def __repr__(self):
+        return "<%s %s %r, %d files, %d pieces>" % (
+            self.__class__.__name__, self.info_hash, self.name, len(self.files), len(self.pieces))
+
+
+def compact(meta, info_hash=None):
+    """ Create a L{CompactTorrent} from a decoded metafile.
+
+        Decode with C{raw_fields=["pieces"]}, so the pieces blob is left
+        alone by the decoder.
+
+        @param meta: Decoded metafile dict.
+        @param info_hash: Hex info hash, calculated from C{meta} when not given
+            (which needs a re-encode of the C{info} dict).
+        @raise KeyError: Missing mandatory keys.
+        @raise ValueError: Malformed C{pieces}.
+    """
+    info = meta["info"]
+    if info_hash is None:
+        info_hash = bencode.info_hash(bencode.bencode({"info": info}))
+    if "files" in info:
+        files = FileList(info["files"])
+    else:
+        files = FileList([((info["name"],), info["length"])])
+
+    return CompactTorrent(info_hash, info["name"], meta.get("announce"),
+                          info["piece length"], PieceHashes(info["pieces"]), files, "files" in info)
+
+
+def load_compact(path):
+    """ Read the metafile at C{path} into a L{CompactTorrent}.
+
+        @raise EnvironmentError: File cannot be read.
+        @raise BencodeError: Invalid data.
+    """
+    with open(path, "rb") as handle:
+        data = handle.read()
+    return compact(bencode.bdecode(data, raw_fields=["pieces"]), bencode.info_hash(data))
+
+
+class Verification(object):
+    """ Result of L{verify}, with the state of each piece in C{good}.
+    """
+    __slots__ = ('torrent', 'good')
+
+    def __init__(self, torrent, good):
+        self.torrent = torrent
+        self.good = good
+
+    @property
+    def complete(self):
+        """ Are all pieces present and correct?
+        """
+        return all(self.good)
+
+    @property
+    def missing(self):
+        """ Number of bad or missing pieces.
+        """
+        return len(self.good) - sum(self.good)
+
+    def files(self):
+        """ Return the completeness of each file, as the fraction of good pieces
+            overlapping it.
+        """
+        result = []
+        piece_length = self.torrent.piece_length
+        for entry in self.torrent.files:
+            if not entry.length:
+                result.append(1.0)
+                continue
+            first = entry.offset // piece_length
+            last = (entry.offset + entry.length - 1) // piece_length + 1
+            result.append(sum(self.good[first:last]) / float(last - first))
+        return result
+
+
+class _PieceHasher(object):
+    """ Calculate the SHA1 hashes of batches of consecutive pieces (in a worker thread).
+    """
+
+    def __init__(self, files, paths, piece_length):
+        self.files = files
+        self.paths = paths
+        self.piece_length = piece_length
+        self.offsets = files.offsets()
+        self.size = files.size
+
+    def _read(self, fileno, offset, length):
+        """ Read a part of a file, or return C{None} if it's missing or short.
+        """
+        if fileno in self.files.pads:
+            return bytes(bytearray(length))
+        try:
+            with open(self.paths[fileno], "rb") as handle:
+                handle.seek(offset)
+                data = handle.read(length)
+        except EnvironmentError:
+            return None
+        return data if len(data) == length else None
+
+    def __call__(self, first, last):
+        """ Hash pieces C{first} to C{last} (exclusive), and return a list of digests,
+            with C{None} for pieces that cannot be read completely.
+        """
+        piece_length, lengths, offsets = self.piece_length, self.files.lengths, self.offsets
+        start, end = first * piece_length, min(last * piece_length, self.size)
+
+        result = []
+        hasher, filled, intact = hashlib.sha1(), 0, True
+        fileno = max(0, bisect.bisect_right(offsets, start) - 1)
+        while fileno < len(lengths) and offsets[fileno] < end:
+            lo = max(start, offsets[fileno])
+            hi = min(end, offsets[fileno] + lengths[fileno])
+            data = self._read(fileno, lo - offsets[fileno], hi - lo) if hi > lo else b''
+            view = memoryview(data) if data is not None else None
+            pos = lo
+            while pos < hi:
+                size = min(piece_length, self.size - (first + len(result)) * piece_length)
+                chunk = min(hi - pos, size - filled)
+                if view is None:
+                    intact = False
+                else:
+                    hasher.update(view[pos - lo:pos - lo + chunk])
+                filled += chunk
+                pos += chunk
+                if filled == size:
+                    result.append(hasher.digest() if intact else None)
+                    hasher, filled, intact = hashlib.sha1(), 0, True
+            fileno += 1
+
+        return result
+
+
+def _pipelined(func, jobs, workers):
+    """ Call C{func(*job)} for all jobs in a pool of C{workers} threads,
+        and yield the results in order.
+
+        Only about two jobs per thread are in flight at any time, which
+        keeps every thread busy while bounding memory use.
+    """
+    pool = ThreadPool(workers)
+    try:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.apply_async(func, job))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def verify(torrent, datapath, workers=None, progress=None, batch_size=4 * 1024**2):
+    """ Verify downloaded data against the piece hashes of a metafile.
+
+        The content is read in large sequential chunks of about
+        C{batch_size} bytes, and hashed by a pool of threads (C{hashlib}
+        releases the GIL), so both reading and hashing run in parallel.
+
+        @param torrent: A L{CompactTorrent}, or a decoded metafile dict.
+        @param datapath: The content's path, i.e. the data file of a single-file
+            torrent, or the directory holding the files of a multi-file one.
+        @param workers: Number of threads, defaults to the number of CPUs.
+        @param progress: Called with C{(done, total)} piece counts after each batch.
+        @return: A L{Verification} object.
+    """
+    if not isinstance(torrent, CompactTorrent):
+        torrent = compact(torrent)
+    if torrent.multi:
+        paths = [os.path.join(datapath, *i) for i in torrent.files.paths]
+    else:
+        paths = [datapath]
+
+    total = len(torrent.pieces)
+    batch = max(1, batch_size // torrent.piece_length)
+    jobs = ((first, min(first + batch, total)) for first in range(0, total, batch))
+    hasher = _PieceHasher(torrent.files, paths, torrent.piece_length)
+
+    good = bytearray()
+    for digests in _pipelined(hasher, jobs, workers or multiprocessing.cpu_count()):
+        good.extend(digest == torrent.pieces[len(good) + i] for i, digest in enumerate(digests))
+        if progress:
+            progress(len(good), total)
+
+    return Verification(torrent, good)
+
+
+# Merkle tree block size of v2 metafiles (BEP 52)
+V2_BLOCK_SIZE = 16 * 1024
+
+
+def _piece_length(size):
+    """ Pick a piece length giving about 1500 pieces, within 32 KiB to 16 MiB.
+    """
+    length = 32 * 1024
+    while length < 16 * 1024**2 and size // length > 1500:
+        length *= 2
+    return length
+
+
+def _merkle_root(hashes, count, pad):
+    """ Return the merkle root of C{hashes}, padded to C{count} (a power of 2) leaves.
+    """
+    layer = list(hashes)
+    while count > 1:
+        if len(layer) % 2:
+            layer.append(pad)
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+        pad = hashlib.sha256(pad + pad).digest()
+        count //= 2
+    return layer[0] if layer else pad
+
+
+def _pow2(count):
+    """ Round C{count} up to a power of 2.
+    """
+    result = 1
+    while result < count:
+        result *= 2
+    return result
+
+
+def _hash_hybrid(path, size, piece_length, pad_v1, first, last):
+    """ Hash pieces C{first} to C{last} of a file for a hybrid metafile (in a worker thread).
+
+        Return a list of C{(sha1, root)} tuples, where C{root} is the merkle root of
+        the piece (or of the whole file, if it fits into a single piece).
+    """
+    result = []
+    if size > piece_length:
+        blocks = piece_length // V2_BLOCK_SIZE
+    else:
+        blocks = _pow2((size + V2_BLOCK_SIZE - 1) // V2_BLOCK_SIZE)
+    with open(path, "rb") as handle:
+        handle.seek(first * piece_length)
+        for _ in range(first, last):
+            data = handle.read(piece_length)
+            view = memoryview(data)
+            leaves = [hashlib.sha256(view[i:i + V2_BLOCK_SIZE]).digest()
+                      for i in range(0, len(data), V2_BLOCK_SIZE)]
+            sha1 = hashlib.sha1(view)
+            if pad_v1 and len(data) < piece_length:
+                sha1.update(bytearray(piece_length - len(data)))
+            result.append((sha1.digest(), _merkle_root(leaves, blocks, bytes(bytearray(32)))))
+    return result
+
+
+def _walk(datapath):
+    """ Return a sorted list of C{(path, length)} tuples for the files below C{datapath}.
+    """
+    files = []
+    for dirpath, _, filenames in os.walk(datapath):
+        for filename in filenames:
+            abspath = os.path.join(dirpath, filename)
+            path = tuple(os.path.relpath(abspath, datapath).split(os.sep))
+            files.append((path, os.path.getsize(abspath)))
+    # This is the key order of a v2 file tree, which v1 file lists must match
+    files.sort(key=lambda item: [i.encode("utf-8") for i in item[0]])
+    return files
+
+
+def make_metafile(datapath, announce=None, piece_length=None, v2=False, # pylint: disable=too-many-arguments,too-many-locals
+                  private=False, workers=None, progress=None, batch_size=4 * 1024**2):
+    """ Create a metafile dict for the file or directory at C{datapath}.
+
+        Reading and hashing is pipelined across a pool of threads, in
+        batches of about C{batch_size} bytes. Use L{bencode.bwrite} to save
+        the result, or L{create_metafile} to do both in one go.
+
+        @param piece_length: Piece size, a power of 2; chosen from the content
+            size when not given.
+        @param v2: Create a hybrid v1 / v2 metafile (BEP 52) with a file tree
+            and piece layers, and padding files aligning the v1 pieces.
+        @param workers: Number of threads, defaults to the number of CPUs.
+        @param progress: Called with C{(done, total)} byte counts during hashing.
+        @raise ValueError: Invalid C{piece_length}.
+    """
+    datapath = os.path.abspath(datapath)
+    multi = os.path.isdir(datapath)
+    files = _walk(datapath) if multi else [((os.path.basename(datapath),), os.path.getsize(datapath))]
+    total = sum(length for _, length in files)
+    piece_length = piece_length or _piece_length(total)
+    if piece_length & (piece_length - 1) or piece_length < (V2_BLOCK_SIZE if v2 else 1):
+        raise ValueError("Bad piece length %d" % piece_length)
+    workers = workers or multiprocessing.cpu_count()
+    paths = [os.path.join(datapath, *path) if multi else datapath for path, _ in files]
+
+    info = {"name": os.path.basename(datapath), "piece length": piece_length}
+    if private:
+        info["private"] = 1
+    meta = {"info": info, "created by": "pyrobase", "creation date": int(time.time())}
+    if announce:
+        meta["announce"] = announce
+
+    if not v2:
+        total_pieces = (total + piece_length - 1) // piece_length
+        batch = max(1, batch_size // piece_length)
+        jobs = ((first, min(first + batch, total_pieces)) for first in range(0, total_pieces, batch))
+        hasher = _PieceHasher(FileList(files), paths, piece_length)
+        pieces = []
+        for digests in _pipelined(hasher, jobs, workers):
+            if None in digests:
+                raise EnvironmentError("Content changed while hashing %r" % datapath)
+            pieces.extend(digests)
+            if progress:
+                progress(min(len(pieces) * piece_length, total), total)
+    else:
+        batch = max(1, batch_size // piece_length)
+        jobs = []
+        for fileno, (path, length) in enumerate(files):
+            count = (length + piece_length - 1) // piece_length
+            pad_v1 = fileno + 1 < len(files)
+            jobs.extend((paths[fileno], length, piece_length, pad_v1, first, min(first + batch, count))
+                        for first in range(0, count, batch))
+        hashes, done = [], 0
+        for result in _pipelined(_hash_hybrid, jobs, workers):
+            hashes.extend(result)
+            done += len(result)
+            if progress:
+                progress(min(done * piece_length, total), total)
+
+        pieces, layers, tree, v1_files = [], {}, {}, []
+        pad = _merkle_root([], piece_length // V2_BLOCK_SIZE, bytes(bytearray(32)))
+        offset = 0
+        for fileno, (path, length) in enumerate(files):
+            count = (length + piece_length - 1) // piece_length
+            file_hashes = hashes[offset:offset + count]
+            offset += count
+            pieces.extend(sha1 for sha1, _ in file_hashes)
+            node = tree
+            for name in path:
+                node = node.setdefault(name, {})
+            node[""] = {"length": length}
+            if length:
+                roots = [root for _, root in file_hashes]
+                if length > piece_length:
+                    node[""]["pieces root"] = _merkle_root(roots, _pow2(count), pad)
+                    layers[node[""]["pieces root"]] = b"".join(roots)
+                else:
+                    node[""]["pieces root"] = roots[0]
+
+            v1_files.append({"length": length, "path": list(path)})
+            if length % piece_length and fileno + 1 < len(files):
+                padding = piece_length - length % piece_length
+                v1_files.append({"attr": "p", "length": padding, "path": [".pad", str(padding)]})
+
+        info["meta version"] = 2
+        info["file tree"] = tree
+        if multi:
+            info["files"] = v1_files
+        if layers:
+            meta["piece layers"] = layers
+
+    info["pieces"] = b"".join(pieces)
+    if not multi:
+        info["length"] = total
+    elif not v2:
+        info["files"] = [{"length": length, "path": list(path)} for path, length in files]
+
+    return meta
+
+
+def create_metafile(filename, datapath, **kwargs):
+    """ Create a metafile for the content at C{datapath}, and write it to C{filename}.
+
+        See L{make_metafile} for the keyword arguments.
+
+        @return: The metafile dict.
+    """
+    meta = make_metafile(datapath, **kwargs)
+    bencode.bwrite(filename, meta)
+    return meta
@@ -0,0 +1,248 @@
+# pylint: disable=missing-docstring
+""" Bencode benchmarks.
+
+    Not part of the unit tests, call "python src/tests/bench_bencode.py --help".
+
+    Runs decode, encode, projection, skip and round-trip benchmarks over a set of
+    synthetic corpora (metafiles of various shapes, and rtorrent session
+    and resume data), and reports throughput, object rates, and peak memory.
+    Use "--json" to save the results, and "--compare" to check them against
+    an earlier run.
+
+    Copyright (c) 2009-2020 The PyroScope Project <pyroscope.project@gmail.com>
+"""
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import argparse
+import platform
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrobase.bencode import bdecode, bencode  # pylint: disable=wrong-import-position
+
+
+# Projection used for metafiles, as done by the bulk scanner
+METAFILE_SELECT = ("announce", "info/name", "info/length", "info/files/*/length")
+# Projection used for session data, as done when listing downloads
+SESSION_SELECT = ("state", "directory", "custom1", "total_uploaded")
+# Projections of only top-level values, which skip over everything else
+METAFILE_SKIP = ("announce", "info/name")
+SESSION_SKIP = ("state",)
+
+
+def make_torrent(files=100000, pieces=50000):
+    """Create a big multi-file metafile."""
+    return bencode({
+        "announce": "http://tracker.example.com/announce",
+        "info": {
+            "name": "dataset",
+            "piece length": 2**18,
+            "pieces": os.urandom(20 * pieces),
+            "files": [{"length": i * 1000, "path": ["dir%d" % (i % 100), "file%06d.bin" % i]}
+                      for i in range(files)],
+        },
+    })
+
+
+def make_single(pieces=2000):
+    """Create a typical single-file metafile."""
+    return bencode({
+        "announce": "http://tracker.example.com/announce",
+        "announce-list": [["http://tracker.example.com/announce"], ["udp://backup.example.com:6969"]],
+        "comment": "Some content",
+        "created by": "mktor 1.0",
+        "creation date": 1600000000,
+        "info": {
+            "name": "some.movie.2020.mkv",
+            "length": pieces * 2**20 - 12345,
+            "piece length": 2**20,
+            "pieces": os.urandom(20 * pieces),
+        },
+    })
+
+
+def make_session(idx):
+    """Create an rtorrent session dict ("*.torrent.rtorrent")."""
+    return {
+        "chunks_done": 1024, "chunks_wanted": 0, "complete": 1,
+        "custom1": "tv", "custom2": "", "custom3": "", "custom4": "", "custom5": "",
+        "custom": {"memo": "added by watch dir", "tm_completed": "1600000000"},
+        "directory": "/var/torrent/done/tv/item%05d" % idx,
+        "hashing": 0, "ignore_commands": 0, "key": random.randint(0, 2**31), "priority": 2,
+        "state": 1, "state_changed": 1600000000 + idx, "state_counter": 3,
+        "throttle_name": "", "tied_to_file": "/var/torrent/watch/item%05d.torrent" % idx,
+        "timestamp.finished": 1600000000, "timestamp.started": 1600000000,
+        "total_uploaded": random.randint(0, 2**40), "views": ["main", "seeding"],
+    }
+
+
+def make_resume(files=50, pieces=4000):
+    """Create libtorrent resume data, as kept with the rtorrent session."""
+    return {
+        "bitfield": pieces,
+        "files": [{"completed": 40, "mtime": 1600000000 + i, "priority": 1} for i in range(files)],
+        "peers4": os.urandom(6 * 50),
+        "trackers": {
+            "http://tracker.example.com/announce": {"enabled": 1, "extra_tracker": 0},
+            "udp://backup.example.com:6969": {"enabled": 1, "extra_tracker": 1},
+        },
+        "uncertain_pieces.timestamp": 1600000000,
+    }
+
+
+def corpora(scale=1.0):
+    """Return a dict of corpus names to lists of bencoded documents."""
+    random.seed(42)
+    count = max(1, int(2000 * scale))
+    return {
+        "single": [make_single(max(1, int(2000 * scale)))],
+        "multi-100k": [make_torrent(files=max(1, int(100000 * scale)), pieces=max(1, int(50000 * scale)))],
+        "pieces-blob": [make_single(max(1, int(250000 * scale)))],
+        "session": [bencode(make_session(i)) for i in range(count)],
+        "resume": [bencode(dict(make_session(i), libtorrent_resume=make_resume())) for i in range(count // 4 or 1)],
+    }
+
+
+def count_objects(obj):
+    """Count the values in a decoded document (containers included)."""
+    result, stack = 0, [obj]
+    while stack:
+        item = stack.pop()
+        result += 1
+        if isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+    return result
+
+
+def peak_memory(func):
+    """Return the peak memory allocated by a call of func, in bytes (or None)."""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def operations(docs):
+    """Return the benchmarked operations for a corpus, as (name, func) pairs."""
+    objs = [bdecode(i) for i in docs]
+    select, skip = (METAFILE_SELECT, METAFILE_SKIP) if "info" in objs[0] else (SESSION_SELECT, SESSION_SKIP)
+    return [
+        ("decode", lambda: [bdecode(i) for i in docs]),
+        ("encode", lambda: [bencode(i) for i in objs]),
+        ("projection", lambda: [bdecode(i, select=select) for i in docs]),
+        ("skip", lambda: [bdecode(i, select=skip) for i in docs]),
+        ("round-trip", lambda: [bencode(bdecode(i)) for i in docs]),
+    ]
+
+
+def bench(corpus, name, func, size, objects, repeat=5):
+    """Run func a few times, and return a result record using the best time."""
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    return dict(
+        corpus=corpus, operation=name, seconds=best,
+        mb_per_sec=size / best / 1024**2, objects_per_sec=objects / best,
+        peak_memory=peak_memory(func),
+    )
+
+
+def compare(results, baseline):
+    """Print the change of each result against a baseline run, and return the worst ratio."""
+    old = dict(((i["corpus"], i["operation"]), i) for i in baseline["results"])
+    worst = None
+    print("\nCompared to {label} (throughput ratio, higher is better):".format(**baseline))
+    for item in results:
+        before = old.get((item["corpus"], item["operation"]))
+        if before:
+            ratio = before["seconds"] / item["seconds"]
+            worst = ratio if worst is None else min(worst, ratio)
+            print("{corpus:12s} {operation:12s} {0:6.2f}x".format(ratio, **item))
+    return worst
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bdecode / bencode.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="scale factor for the corpus sizes (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed runs, the best one is reported (default: %(default)s)")
+    parser.add_argument("--corpus", action="append", default=[],
+                        help="only run the given corpus (can be repeated)")
+    parser.add_argument("--label", default=None,
+                        help="name of this run in the JSON results (default: Python version)")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare against the JSON results of an earlier run")
+    parser.add_argument("--fail-under", type=float, default=None, metavar="RATIO",
+                        help="exit with an error if any throughput ratio is below RATIO")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    print("{:12s} {:12s} {:>9s} {:>9s} {:>12s} {:>10s}".format(
+        "corpus", "operation", "sec", "MB/s", "objects/s", "peak MiB"))
+    for corpus, docs in sorted(corpora(args.scale).items()):
+        if args.corpus and corpus not in args.corpus:
+            continue
+        size = sum(len(i) for i in docs)
+        objects = sum(count_objects(bdecode(i)) for i in docs)
+        for name, func in operations(docs):
+            item = bench(corpus, name, func, size, objects, repeat=args.repeat)
+            item.update(size=size, documents=len(docs), objects=objects)
+            results.append(item)
+            print("{corpus:12s} {operation:12s} {seconds:9.4f} {mb_per_sec:9.1f} {objects_per_sec:12.0f} {0:>10s}"
+                  .format("-" if item["peak_memory"] is None else "%.1f" % (item["peak_memory"] / 1024.0**2),
+                          **item))
+
+    report = dict(
+        label=args.label or "Python " + platform.python_version(),
+        python=sys.version, platform=platform.platform(), timestamp=int(time.time()),
+        scale=args.scale, results=results,
+    )
+    if args.json:
+        with open(args.json, "w") as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            worst = compare(results, json.load(handle))
+        if args.fail_under is not None and worst is not None and worst < args.fail_under:
+            print("Throughput regression: worst ratio {:.2f} < {:.2f}".format(worst, args.fail_under))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
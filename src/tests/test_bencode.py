@@ -21,6 +21,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 from __future__ import absolute_import, print_function  #, unicode_literals
 
+import json
+import socket
+import hashlib
 import unittest
 
 try:
@@ -30,6 +33,7 @@ except ImportError:
 
 import pytest
 
+from pyrobase.parts import Bunch
 from pyrobase.testing import mockedopen
 from pyrobase.bencode import * #@UnusedWildImport
 
@@ -66,6 +70,10 @@ from pyrobase.bencode import * #@UnusedWildImport
     b"d0:0:",
     b"d0:",
     b"10:45646",
+    b"li12",
+    b"di1ei12",
+    b"l12",
+    b"d1:al3",
 ])
 def test_bdecode_errors(val):
     with pytest.raises(BencodeError):
@@ -93,6 +101,57 @@ def test_bdecode_errors(val):
 def test_bdecode_values(val, expected):
     assert bdecode(val) == expected
 
+def test_bdecode_deeply_nested():
+    depth = 100000
+    obj = bdecode(b"l" * depth + b"i1e" + b"e" * depth)
+    for _ in range(depth):
+        obj, = obj
+    assert obj == 1
+
+def test_bdecode_bytearray():
+    assert bdecode(bytearray(b"d1:ali1e1:bee")) == {"a": [1, "b"]}
+
+def test_bdecode_raw_fields():
+    data = b"d4:name3:foo10:path.utf-8l3:dir4:filee6:pieces3:abc5:otherl1:xee"
+    obj = bdecode(data, raw_fields=["pieces", "path.utf-8"])
+
+    assert obj == {"name": "foo", "path.utf-8": [b"dir", b"file"], "pieces": b"abc", "other": ["x"]}
+    assert bdecode(data, lazy=True, raw_fields=["pieces"])["pieces"].value == b"abc"
+
+def test_bdecode_interned_keys():
+    first = bdecode(b"ld6:lengthi1eed6:lengthi2eee")
+    second = bdecode(b"d6:lengthi3ee")
+    keys = [list(i.keys())[0] for i in first + [second]]
+
+    assert keys == ["length"] * 3
+    assert keys[0] is keys[1] and keys[1] is keys[2]
+
+def test_bdecode_factories():
+    obj = bdecode(b"d4:infod4:name3:foo5:filesli1ei2eeee", dict_factory=Bunch, list_factory=tuple)
+
+    assert isinstance(obj, Bunch) and isinstance(obj.info, Bunch)
+    assert obj.info.name == "foo"
+    assert obj.info.files == (1, 2)
+
+def test_bdecode_factories_select():
+    obj = bdecode(TORRENT, select=["info/files/*/length"], dict_factory=Bunch, list_factory=tuple)
+    assert obj.info.files == ({"length": 1}, {"length": 2})
+    assert isinstance(obj.info.files[0], Bunch)
+
+def test_bdecode_canonical_round_trip():
+    obj = bdecode(TORRENT, dict_factory=CanonicalDict)
+    assert bencode(obj) == TORRENT
+
+def test_bdecode_object_hook():
+    class Item(object):
+        __slots__ = ("name", "size")
+
+        def __init__(self, name, size):
+            self.name, self.size = name, size
+
+    obj = bdecode(b"ld4:name1:a4:sizei1eed4:name1:b4:sizei2eee", object_hook=lambda d: Item(**d))
+    assert [(i.name, i.size) for i in obj] == [("a", 1), ("b", 2)]
+
 def test_bdecode_encoding():
     assert bdecode(b"l1:\x801:\x81e", "cp1252") == [u"\u20ac", b"\x81"]
 
@@ -103,6 +162,390 @@ def test_bdecode_bread_file():
     with mockedopen(fakefiles={"empty_dict": "de"}, mode='b'):
         assert bread("empty_dict") == {}
 
+@pytest.mark.parametrize('val, expected', [
+    (b"i4e", 4),
+    (b"3:abc", "abc"),
+    (b"ll5:Alice3:Bobeli2ei3eee", [["Alice", "Bob"], [2, 3]]),
+    (b"d3:agei25e4:eyes4:bluee", {"age": 25, "eyes": "blue"}),
+])
+def test_bdecode_memoryview(val, expected):
+    assert bdecode(memoryview(val)) == expected
+    assert bdecode(memoryview(val), lazy=True) == expected
+
+def test_bdecode_lazy():
+    data = bytearray(b"d4:name3:foo6:pieces3:\x00\x01\xffe")
+    obj = bdecode(data, lazy=True)
+
+    assert isinstance(obj["pieces"], LazyString)
+    assert obj["name"] == "foo"
+    assert obj["pieces"].value == b"\x00\x01\xff"
+    assert len(obj["pieces"]) == 3
+    data[22] = ord("X")  # views share the underlying buffer
+    assert obj["pieces"].tobytes() == b"X\x01\xff"
+    assert bencode(obj) == bytes(data)
+
+@pytest.mark.parametrize('val', [
+    b"9999:x",
+    b"l3:abe",
+])
+def test_bdecode_lazy_errors(val):
+    with pytest.raises(BencodeError):
+        bdecode(val, lazy=True)
+
+def test_bdecode_bread_mmap(tmpdir):
+    path = tmpdir.join("lazy.torrent")
+    path.write_binary(b"d4:infod6:lengthi42e4:name3:fooee")
+    obj = bread(str(path), lazy=True)
+
+    assert isinstance(obj["info"]["name"], LazyString)
+    assert obj == {"info": {"length": 42, "name": "foo"}}
+
+TORRENT = (
+    b"d8:announce3:url4:infod5:filesld6:lengthi1e4:pathl1:aeed6:lengthi2e4:pathl1:beee"
+    b"4:name3:foo6:pieces4:\xff\xfe\xfd\xfcee"
+)
+
+@pytest.mark.parametrize('select, expected', [
+    ([], {}),
+    (["announce"], {"announce": "url"}),
+    (["info/name", "/announce/"], {"announce": "url", "info": {"name": "foo"}}),
+    (["info/files/*/length"], {"info": {"files": [{"length": 1}, {"length": 2}]}}),
+    (["info/files/1/path"], {"info": {"files": [{"path": ["b"]}]}}),
+    (["info/files", "info/files/*/length"], {"info": {"files": bdecode(TORRENT)["info"]["files"]}}),
+    (["*/name"], {"info": {"name": "foo"}}),
+    (["info/files/*/length", "info/files/1/path"],
+     {"info": {"files": [{"length": 1}, {"length": 2, "path": ["b"]}]}}),
+    (["announce/deeper", "missing/key"], {}),
+])
+def test_bdecode_select(select, expected):
+    assert bdecode(TORRENT, select=select) == expected
+
+@pytest.mark.parametrize('val', [
+    b"d1:ai1ee" + b"x",
+    b"d1:ali1ee",
+    b"d1:a3:xye",
+    b"d1:ai1",
+    b"d1:al1:xze",
+    b"d1:al99999999999999999999:xe1:bi1ee",
+])
+def test_bdecode_select_errors(val):
+    with pytest.raises(BencodeError):
+        bdecode(val, select=["b"])
+
+SELECTED = {"info": {"name": "foo", "files": [{"length": 1}, {"length": 2}]}}
+
+@pytest.mark.parametrize('data, select, expected', [
+    (bytearray(TORRENT), ["info/name", "info/files/*/length"], SELECTED),
+    (memoryview(TORRENT), ["info/name", "info/files/*/length"], SELECTED),
+    # long strings and deep nesting are beyond the skip regexes
+    (bencode({"a": ["x" * 5000, [[[[[[[["deep"]]]]]]]], {"b": "y" * 150}], "b": {"c": 1, "d": [1, 2]}}),
+     ["b/c", "a/*/b"], {"a": [[], {"b": "y" * 150}], "b": {"c": 1}}),
+    (bencode({"b": {"a": "x" * 100, "c": [[[[[[[[1]]]]]]]], "d": 1}}), ["b/d", "b/e"], {"b": {"d": 1}}),
+    (b"d2:\xff\xfed1:ai1eee", ["\xff\xfe/a"], {b"\xff\xfe": {"a": 1}}),
+])
+def test_bdecode_select_skipping(data, select, expected):
+    assert bdecode(data, select=select) == expected
+
+@pytest.mark.parametrize('path, expected', [
+    ("", (0, len(TORRENT))),
+    ("announce", (11, 16)),
+    ("info/name", (TORRENT.index(b"3:foo"), TORRENT.index(b"3:foo") + 5)),
+    ("info/files/1/length", (TORRENT.index(b"i2e"), TORRENT.index(b"i2e") + 3)),
+])
+def test_bspan(path, expected):
+    assert bspan(TORRENT, path) == expected
+
+@pytest.mark.parametrize('path', [
+    "missing",
+    "announce/deeper",
+    "info/files/2",
+    "info/files/x",
+])
+def test_bspan_missing(path):
+    with pytest.raises(KeyError):
+        bspan(TORRENT, path)
+
+def test_info_hash():
+    info = bencode(bdecode(TORRENT)["info"])
+    assert info_hash(TORRENT) == hashlib.sha1(info).hexdigest()
+    assert info_hash(BytesIO(TORRENT), "sha256") == hashlib.sha256(info).hexdigest()
+
+def test_info_hash_noncanonical(tmpdir):
+    info = b"d4:name3:foo6:lengthi1ee"  # keys not sorted
+    path = tmpdir.join("noncanonical.torrent")
+    path.write_binary(b"d4:info" + info + b"e")
+
+    assert info_hash(path.strpath) == hashlib.sha1(info).hexdigest()
+    assert info_hash(path.strpath) != hashlib.sha1(bencode(bdecode(info))).hexdigest()
+
+@pytest.mark.parametrize('changes', [
+    {},
+    {"announce": "http://example.com/"},
+    {"info/name": "bar", "info/files/0/length": 42},
+    {"info/files/1": {"length": 3, "path": ["c"]}},
+    {"comment": "new", "creation date": 1, "zzz": [1]},
+    {"info/aaa": 1, "info/length": 7, "info/zzz": {}},
+    {"info/pieces": None, "info/files/0": None},
+    {"": {"replaced": 1}},
+])
+def test_bpatch(changes):
+    expected = bdecode(TORRENT)
+    for path, value in changes.items():
+        parent, _, name = path.rpartition('/')
+        obj = expected
+        for key in parent.split('/') if parent else []:
+            obj = obj[int(key)] if isinstance(obj, list) else obj[key]
+        if not name:
+            expected = value
+        elif value is None:
+            del obj[int(name) if isinstance(obj, list) else name]
+        elif isinstance(obj, list):
+            obj[int(name)] = value
+        else:
+            obj[name] = value
+
+    patched = bpatch(TORRENT, changes)
+    assert patched == bencode(expected), "result must be canonical"
+
+def test_bpatch_noncanonical():
+    data = b"d1:bi1e1:ai2e1:ci3ee"
+    assert bpatch(data, {"a": 5, "bb": 0}) == b"d1:bi1e1:ai5e2:bbi0e1:ci3ee"
+
+@pytest.mark.parametrize('changes, exc', [
+    ({"missing/key": 1}, KeyError),
+    ({"info/nope": None}, KeyError),
+    ({"info/files/5": 1}, KeyError),
+    ({"announce/x": 1}, KeyError),
+    ({"info": {}, "info/name": "x"}, ValueError),
+])
+def test_bpatch_errors(changes, exc):
+    with pytest.raises(exc):
+        bpatch(TORRENT, changes)
+
+def test_bpatch_file(tmpdir):
+    path = tmpdir.join("session.rtorrent")
+    path.write_binary(TORRENT)
+    path.chmod(0o600)
+    bpatch_file(path.strpath, {"info/name": "bar", "state": 1})
+
+    assert path.read_binary() == bpatch(TORRENT, {"info/name": "bar", "state": 1})
+    assert path.stat().mode & 0o777 == 0o600
+    assert tmpdir.listdir() == [path], "temporary file must be gone"
+
+def test_bpatch_file_error(tmpdir):
+    path = tmpdir.join("session.rtorrent")
+    path.write_binary(TORRENT)
+    with pytest.raises(KeyError):
+        bpatch_file(path.strpath, {"missing/key": 1})
+
+    assert path.read_binary() == TORRENT
+    assert tmpdir.listdir() == [path]
+
+@pytest.mark.parametrize('data, expected', [
+    (b"i-42e", -42),
+    (b"3:foo", "foo"),
+    (b"le", []),
+    (b"de", {}),
+    (b"ld1:a3:\xff\x00\xfeei1ee", [{"a": "ff00fe"}, 1]),
+    (b"d3:\xffxxi1ee", {"ff7878": 1}),
+    (TORRENT, {"announce": "url", "info": {
+        "files": [{"length": 1, "path": ["a"]}, {"length": 2, "path": ["b"]}],
+        "name": "foo", "pieces": "fffefdfc"}}),
+])
+def test_bjson(data, expected):
+    assert json.loads(bjson(data)) == expected
+
+def test_bjson_options():
+    assert json.loads(bjson(TORRENT, binary="base64"))["info"]["pieces"] == "//79/A=="
+    assert json.loads(bjson(TORRENT, elide=["pieces", "files"]))["info"] == {
+        "files": {"elided": 50}, "name": "foo", "pieces": {"elided": 6}}
+    assert json.loads(bjson(TORRENT, char_encoding=None))["616e6e6f756e6365"] == "75726c"
+
+def test_bjson_iter_chunks():
+    data = bencode({"pieces": b"\xff" * 1000, "x": list(range(500))})
+    chunks = list(bjson_iter(data, chunk_size=100))
+
+    assert len(chunks) > 10
+    assert max(len(i) for i in chunks) < 200
+    assert json.loads("".join(chunks)) == {"pieces": "ff" * 1000, "x": list(range(500))}
+
+@pytest.mark.parametrize('data', [b"", b"x", b"i1", b"l", b"li1e", b"di1ei2ee", b"5:abc", b"d1:ae",
+                                  b"i1ei2e", b"lee", b"d1a", b"1", b"l1:a"])
+def test_bjson_errors(data):
+    with pytest.raises(BencodeError):
+        bjson(data)
+
+def test_bjson_truncated():
+    with pytest.raises(BencodeError, match="Unexpected end of data"):
+        bjson(b"d1:al")
+
+def test_bjson_main(tmpdir, capsys):
+    tmpdir.join("a.torrent").write_binary(TORRENT)
+    tmpdir.join("b.torrent").write_binary(b"d1:xi1ee")
+    tmpdir.join("bad.torrent").write_binary(b"d1:x")
+    paths = [tmpdir.join(i).strpath for i in ("a.torrent", "bad.torrent", "b.torrent")]
+
+    assert main(["-n", "-e", "pieces", "--with-path"] + paths) == 1
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert len(lines) == 2, "no partial line for the bad file"
+    assert json.loads(lines[0])["data"]["info"]["pieces"] == {"elided": 6}
+    assert json.loads(lines[-1]) == {"path": paths[-1], "data": {"x": 1}}
+    assert "bad.torrent" in err
+
+    assert main([paths[0], "-o", tmpdir.join("out.json").strpath]) == 0
+    assert json.loads(tmpdir.join("out.json").read())["announce"] == "url"
+
+    assert main(["-e", "pieces"] + paths) == 1
+    out, err = capsys.readouterr()
+    assert json.loads(out) == [json.loads(bjson(TORRENT, elide=["pieces"])), {"x": 1}]
+    assert "bad.torrent" in err
+
+FileRec = record_type("FileRec", [("length", int), ("path", [str])])
+InfoRec = record_type("InfoRec", [("name", str), ("pieces", bytes), ("files", [FileRec]), ("piece length", int)])
+TorrentRec = record_type("TorrentRec", {"announce": str, "info": InfoRec})
+
+def test_record_type():
+    rec = FileRec(length=1, path=["a"], attr="p")
+
+    assert FileRec.__slots__ == ("length", "path")
+    assert not hasattr(rec, "__dict__")
+    assert rec.length == 1 and rec.extra == {"attr": "p"}
+    assert InfoRec(piece_length=2).piece_length == 2
+    assert InfoRec().name is None
+    assert repr(rec) == "FileRec(length=1, path=['a'])"
+
+@pytest.mark.parametrize('fields', [
+    [("a.b", int), ("a_b", int)],
+    [("piece length", int), ("piece-length", int)],
+    [("extra", dict)],
+    [("to_dict", int)],
+])
+def test_record_type_clashes(fields):
+    with pytest.raises(ValueError):
+        record_type("Clash", fields)
+
+def test_bdecode_schema():
+    torrent = bdecode(TORRENT, schema=TorrentRec)
+
+    assert isinstance(torrent, TorrentRec)
+    assert torrent.announce == "url"
+    assert torrent.info.pieces == b"\xff\xfe\xfd\xfc"
+    assert [i.path for i in torrent.info.files] == [["a"], ["b"]]
+    assert torrent.info.files[1] == FileRec(length=2, path=["b"])
+    assert torrent.info.piece_length is None
+    assert torrent._extra is None and torrent.info._extra is None
+    assert bencode(torrent) == TORRENT
+    assert Decoder(TORRENT, raw_fields=["pieces"]).decode(schema=TorrentRec) == torrent
+    assert bdecode(TORRENT, schema=TorrentRec, select=["info/files"]).info.files == torrent.info.files
+
+def test_bdecode_schema_extra():
+    data = b"d4:infod4:name3:foo5:otheri1ee5:zzzzzli1eee"
+    torrent = bdecode(data, schema=TorrentRec)
+
+    assert torrent.extra == {"zzzzz": [1]}
+    assert torrent.info.extra == {"other": 1}
+    assert bencode(torrent) == data
+
+@pytest.mark.parametrize('data', [
+    b"d8:announcei1ee",
+    b"d4:infoli1eee",
+    b"d4:infod5:filesd1:ai1eeee",
+    b"d4:infod5:filesld6:length1:xeeee",
+    b"li1ee",
+])
+def test_bdecode_schema_errors(data):
+    with pytest.raises(BencodeError):
+        bdecode(data, schema=TorrentRec)
+
+def test_bview():
+    view = bview(TORRENT)
+
+    assert isinstance(view, BencodeDictView)
+    assert len(view) == 2 and "info" in view and "nope" not in view
+    assert list(view) == ["announce", "info"]
+    assert view["info"]["name"] == "foo"
+    assert view["info"] is view["info"], "items must be cached"
+    assert view["info"]["files"][-1]["length"] == 2
+    assert view["info"]["files"][:1] == [{"length": 1, "path": ["a"]}]
+    assert view == bdecode(TORRENT)
+    assert view["info"].decode() == bdecode(TORRENT)["info"]
+    assert view.span == (0, len(TORRENT))
+
+def test_skip_ends():
+    ends = {}
+    decoder = Decoder(b"ld1:ali1eeee1:x")
+    assert decoder.skip(ends) == 0
+    assert ends == {0: 12, 1: 11, 5: 10}
+
+    decoder.offset = 1
+    decoder.data = None  # known containers must not be scanned again
+    decoder.skip(ends)
+    assert decoder.offset == 11
+
+def test_bview_lazy():
+    view = bview(memoryview(TORRENT), lazy=True)
+    assert isinstance(view["info"]["pieces"], LazyString)
+    assert list(view["info"]) == ["files", "name", "pieces"]
+
+def test_bview_raw_fields():
+    data = b"d4:name3:foo10:path.utf-8l3:dir4:filee6:pieces3:abce"
+    view = bview(data, raw_fields=["pieces", "path.utf-8"])
+
+    assert view["pieces"] == b"abc" and view["name"] == "foo"
+    assert list(view["path.utf-8"]) == [b"dir", b"file"]
+    assert view["path.utf-8"].decode() == [b"dir", b"file"]
+    assert view == bdecode(data, raw_fields=["pieces", "path.utf-8"])
+
+@pytest.mark.parametrize('val, expected', [
+    (b"i1e", 1),
+    (b"3:abc", "abc"),
+])
+def test_bview_scalar(val, expected):
+    assert bview(val) == expected
+
+def test_bview_errors():
+    with pytest.raises(BencodeError):
+        len(bview(b"d1:ai1e1:b"))
+    with pytest.raises(KeyError):
+        bview(TORRENT)["missing"]  # pylint: disable=expression-not-assigned
+    with pytest.raises(IndexError):
+        bview(TORRENT)["info"]["files"][2]  # pylint: disable=expression-not-assigned
+
+def test_incremental_decoder_bytewise():
+    data = b"d3:agei25e4:eyes4:bluee" + b"l3:abci-1ee" + b"0:" + b"i42e"
+    decoder = IncrementalDecoder()
+    result = []
+    for idx in range(len(data)):
+        result.extend(decoder.feed(data[idx:idx+1]))
+    decoder.close()
+
+    assert result == [{"age": 25, "eyes": "blue"}, ["abc", -1], "", 42]
+
+def test_incremental_decoder_partial():
+    decoder = IncrementalDecoder()
+    assert decoder.feed(b"li1e10:12345") == []
+    assert decoder.feed(b"67890ei2") == [[1, "1234567890"]]
+    assert decoder.feed(b"e") == [2]
+
+@pytest.mark.parametrize('val', [
+    b"x",
+    b"le" + b"e",
+    b"l3x:abce",
+])
+def test_incremental_decoder_errors(val):
+    with pytest.raises(BencodeError):
+        IncrementalDecoder().feed(val)
+
+def test_incremental_decoder_close():
+    decoder = IncrementalDecoder()
+    decoder.feed(b"l4:sp")
+    with pytest.raises(BencodeError):
+        decoder.close()
+
+def test_bdecode_bread_iter():
+    assert list(bread_iter(BytesIO(b"dei1e3:abc"), chunk_size=2)) == [{}, 1, "abc"]
+
 
 class DunderBencode(object):
     def __init__(self, num):
@@ -146,6 +589,65 @@ def test_bencode_errors(val):
 def test_bencode_values(val, expected):
     assert bencode(val) == expected
 
+def test_bencode_canonical_dict():
+    # Order is taken as-is, to prove that no sorting happens
+    obj = CanonicalDict([(b"b", 1), (b"a", CanonicalDict([("y", 2), ("x", 3)]))])
+    assert bencode(obj) == b"d1:bi1e1:ad1:yi2e1:xi3eee"
+
+@pytest.mark.parametrize('val, expected', [
+    (type(str("IntSub"), (int,), {})(7), b"i7e"),
+    (type(str("DictSub"), (dict,), {})(a=1), b"d1:ai1ee"),
+    (type(str("BytesSub"), (bytes,), {})(b"abc"), b"3:abc"),
+    (bytearray(b"abc"), b"3:abc"),
+    (memoryview(b"abc"), b"3:abc"),
+    ((1, (2,)), b"li1eli2eee"),
+])
+def test_bencode_type_dispatch(val, expected):
+    assert bencode(val) == expected
+    assert bencode(val) == expected, "cached kind must give the same result"
+
+def test_bencode_key_cache():
+    encoder = Encoder()
+    encoder.key_cache.clear()
+    encoder.encode({"length": 1, "path": 2})
+    encoder.encode({b"path": 3, b"length": 4})
+    encoder.encode({5: 6})
+
+    assert b"".join(encoder.result) == b"d6:lengthi1e4:pathi2eed6:lengthi4e4:pathi3eed1:5i6ee"
+    assert encoder.key_cache == {"length": b"6:length", "path": b"4:path",
+                                 b"length": b"6:length", b"path": b"4:path"}
+
+def test_bencode_raw():
+    assert bencode([Bencoded(b"i1e"), {"a": Bencoded(b"le")}]) == b"li1ed1:aleee"
+
+def test_bencode_cache():
+    cache = EncodingCache()
+    info = {"name": "foo", "pieces": b"x" * 20}
+    session = {"info": info, "timestamp": 1}
+    expected = bencode(session)
+
+    assert bencode(session, cache=cache) == expected
+    assert (cache.hits, cache.misses) == (0, 1)
+    session["timestamp"] = 2
+    assert bencode(session, cache=cache) == bencode(session)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    info["name"] = "bar"  # changed in place, so must be invalidated
+    cache.invalidate(info)
+    assert bencode(session, cache=cache) == bencode(session)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    session["info"] = dict(info)  # new object means a cache miss
+    assert bencode(session, cache=cache) == bencode(session)
+    assert (cache.hits, cache.misses) == (1, 3)
+
+def test_bencode_cache_version():
+    cache = EncodingCache(keys=["files"], version=len)
+    assert bencode({"files": [1, 2]}, cache=cache) == b"d5:filesli1ei2eee"
+    assert bencode({"files": [3, 4]}, cache=cache) == b"d5:filesli1ei2eee", "same version"
+    assert bencode({"files": [5]}, cache=cache) == b"d5:filesli5eee"
+    assert (cache.hits, cache.misses) == (1, 2)
+
 def test_bencode_bwrite_stream():
     data = BytesIO()
     bwrite(data, {})
@@ -156,6 +658,36 @@ def test_bencode_bwrite_file():
         bwrite("data", {})
         assert files["data"] == b"de"
 
+def test_bencode_bwrite_error(tmpdir):
+    path = tmpdir.join("data")
+    with pytest.raises(BencodeError):
+        bwrite(path.strpath, [b"x" * 70000, object()])
+    assert path.read_binary() == b""
+
+def test_bencode_bwrite_socket():
+    reader, writer = socket.socketpair()
+    try:
+        bwrite(writer, [b"x" * 10, 42], chunk_size=4)
+        writer.close()
+        assert list(bread_iter(reader.makefile("rb"))) == [["x" * 10, 42]]
+    finally:
+        reader.close()
+
+def test_bencode_iter_chunks():
+    obj = {"big": b"x" * 100, "list": list(range(100)), "small": "abc"}
+    chunks = list(bencode_iter(obj, chunk_size=32))
+
+    assert b"".join(chunks) == bencode(obj)
+    assert b"x" * 100 in chunks, "big strings are passed on as-is"
+    assert max(len(i) for i in chunks if i != b"x" * 100) < 2 * 32
+
+def test_bencode_deeply_nested():
+    depth = 100000
+    obj = 1
+    for _ in range(depth):
+        obj = [obj]
+    assert bencode(obj) == b"l" * depth + b"i1e" + b"e" * depth
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
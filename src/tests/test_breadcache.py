@@ -0,0 +1,75 @@
+# pylint: disable=missing-docstring
+""" Bencode file cache tests.
+
+    Copyright (c) 2009-2020 The PyroScope Project <pyroscope.project@gmail.com>
+"""
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from __future__ import absolute_import, print_function
+
+import pytest
+
+from pyrobase.bencode import bdecode, bencode
+from pyrobase.breadcache import BreadCache
+
+from .test_bencode import TORRENT
+
+
+def test_bread_cache(tmpdir):
+    path = tmpdir.join("cached.torrent")
+    path.write_binary(TORRENT)
+    dbfile = tmpdir.join("cache.db").strpath
+
+    with BreadCache(dbfile) as cache:
+        assert cache.bread(path.strpath) == bdecode(TORRENT)
+        assert cache.bread(path.strpath) == bdecode(TORRENT)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    with BreadCache(dbfile) as cache:
+        assert cache.bread(path.strpath) == bdecode(TORRENT)
+        assert (cache.hits, cache.misses) == (1, 0), "entries must persist"
+
+        path.write_binary(b"d1:ai1ee")
+        assert cache.bread(path.strpath) == {"a": 1}
+        assert (cache.hits, cache.misses) == (1, 1), "changed files must be re-read"
+
+def test_bread_cache_verify(tmpdir):
+    path = tmpdir.join("cached.torrent")
+    path.write_binary(b"d1:ai1ee")
+    stat = path.stat()
+
+    with BreadCache(tmpdir.join("cache.db").strpath, verify=True) as cache:
+        cache.bread(path.strpath)
+        path.write_binary(b"d1:ai2ee")
+        path.setmtime(stat.mtime)  # same size and mtime, but different content
+        assert cache.bread(path.strpath) == {"a": 2}
+        assert (cache.hits, cache.misses) == (0, 2)
+
+def test_bread_cache_evict(tmpdir):
+    paths = []
+    for idx in range(3):
+        paths.append(tmpdir.join("%d.torrent" % idx))
+        paths[-1].write_binary(bencode(idx))
+
+    with BreadCache(tmpdir.join("cache.db").strpath, max_entries=2) as cache:
+        for path in paths:
+            cache.bread(path.strpath)
+        assert cache.size == 2
+        cache.bread(paths[2].strpath)
+        cache.bread(paths[0].strpath)
+        assert (cache.hits, cache.misses) == (1, 4)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,242 @@
+# pylint: disable=missing-docstring
+""" Metafile tests.
+
+    Copyright (c) 2009-2020 The PyroScope Project <pyroscope.project@gmail.com>
+"""
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+
+import pytest
+
+from pyrobase import bencode, metafile
+
+
+SINGLE = {
+    "announce": "http://tracker.example.com/announce",
+    "info": {"name": "single.bin", "length": 1000, "piece length": 2**18, "pieces": b"\xff" * 20},
+}
+MULTI = {
+    "announce": "http://tracker.example.com/announce",
+    "info": {
+        "name": "multi", "piece length": 2**18, "pieces": b"\xfe" * 20, "source": "TEST",
+        "files": [{"length": 10, "path": ["a"]}, {"length": 20, "path": ["b", "c"]}],
+    },
+}
+
+
+@pytest.fixture
+def torrents(tmpdir):
+    paths = []
+    for name, meta in (("single", SINGLE), ("multi", MULTI)):
+        paths.append(tmpdir.join(name + ".torrent").strpath)
+        bencode.bwrite(paths[-1], meta)
+    paths.append(tmpdir.join("broken.torrent").strpath)
+    with open(paths[-1], "wb") as handle:
+        handle.write(b"d4:info")
+    return paths
+
+
+def test_summarize(torrents):
+    record = metafile.summarize(torrents[1], fields=["info/source", "info/files/1/path"])
+
+    assert record.info_hash == hashlib.sha1(bencode.bencode(MULTI["info"])).hexdigest()
+    assert record.name == "multi"
+    assert (record.size, record.files) == (30, 2)
+    assert record.announce == MULTI["announce"]
+    assert record.fields == ("TEST", ["b", "c"])
+    assert record.error is None
+
+def test_summarize_error(torrents):
+    record = metafile.summarize(torrents[2])
+    assert record.error and record.info_hash is None
+
+@pytest.mark.parametrize('meta', [
+    [1, 2],
+    {"info": "notadict"},
+    {"info": {"name": "x", "files": [{"length": "3", "path": ["a"]}]}},
+    {"info": {"name": "x", "files": ["a"]}},
+    {"info": {"name": "x", "files": {}}},
+    {"info": {"name": "x", "length": -1}},
+    {"info": {"name": "x"}},
+    {"info": {"name": 1, "length": 1}},
+    {"announce": [], "info": {"name": "x", "length": 1}},
+])
+def test_summarize_bad_fields(tmpdir, meta):
+    path = tmpdir.join("bad.torrent").strpath
+    bencode.bwrite(path, meta)
+    record = metafile.summarize(path)
+
+    assert record.error and record.info_hash is None
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_scan_torrents(torrents, workers):
+    records = list(metafile.scan_torrents(torrents + ["/does/not/exist"], workers=workers, chunk_size=1))
+
+    assert [i.path for i in records] == torrents + ["/does/not/exist"]
+    assert [(i.name, i.size, i.files) for i in records[:2]] == [("single.bin", 1000, 1), ("multi", 30, 2)]
+    assert [bool(i.error) for i in records] == [False, False, True, True]
+
+def test_scan_torrents_incremental(torrents):
+    previous = dict((i.path, i) for i in metafile.scan_torrents(torrents, workers=1))
+    bencode.bwrite(torrents[0], dict(SINGLE, announce="http://changed.example.com/"))
+    records = list(metafile.scan_torrents(torrents, workers=1, previous=previous))
+
+    assert records[0].announce == "http://changed.example.com/"
+    assert records[1] is previous[torrents[1]]
+    assert records[2] is not previous[torrents[2]], "errors are always rescanned"
+
+
+def test_metafile_record(torrents):
+    meta = bencode.bread(torrents[1], schema=metafile.MetafileRecord)
+
+    assert isinstance(meta.info, metafile.InfoRecord)
+    assert meta.info.source == "TEST"
+    assert meta.info.piece_length == 2**18
+    assert meta.info.pieces == MULTI["info"]["pieces"]
+    assert sum(i.length for i in meta.info.files) == 30
+    assert meta.to_dict() == MULTI
+
+def test_piece_hashes():
+    pieces = metafile.PieceHashes(b"a" * 20 + b"b" * 20)
+
+    assert len(pieces) == 2
+    assert pieces[-1] == b"b" * 20
+    assert list(pieces) == pieces[:] == [b"a" * 20, b"b" * 20]
+    with pytest.raises(IndexError):
+        pieces[2] # pylint: disable=pointless-statement
+    with pytest.raises(ValueError):
+        metafile.PieceHashes(b"x" * 21)
+
+def test_file_list():
+    files = metafile.FileList(MULTI["info"]["files"])
+
+    assert files.size == 30
+    assert files.lengths.typecode == metafile.LENGTH_TYPECODE
+    assert list(files) == [metafile.FileEntry(("a",), 10, 0), metafile.FileEntry(("b", "c"), 20, 10)]
+    assert files[-1].path == ("b", "c")
+
+@pytest.mark.parametrize('idx', [0, 1])
+def test_load_compact(torrents, idx):
+    torrent = metafile.load_compact(torrents[idx])
+    meta = (SINGLE, MULTI)[idx]
+
+    assert torrent.info_hash == hashlib.sha1(bencode.bencode(meta["info"])).hexdigest()
+    assert torrent.info_hash == metafile.compact(meta).info_hash
+    assert torrent.name == meta["info"]["name"]
+    assert torrent.pieces == metafile.PieceHashes(meta["info"]["pieces"])
+    assert torrent.size == (1000, 30)[idx]
+    assert [i.length for i in torrent.piece_files(0)] == ([1000], [10, 20])[idx]
+
+
+def make_content(tmpdir, sizes, piece_length=16):
+    content = b"".join(bytes(bytearray((i + n) % 256 for i in range(size))) for n, size in enumerate(sizes))
+    files = []
+    for n, size in enumerate(sizes):
+        tmpdir.join("data", "f%d" % n).write_binary(content[sum(sizes[:n]):sum(sizes[:n + 1])], ensure=True)
+        files.append({"length": size, "path": ["f%d" % n]})
+    pieces = b"".join(hashlib.sha1(content[i:i + piece_length]).digest()
+                      for i in range(0, len(content), piece_length))
+    return {"info": {"name": "data", "piece length": piece_length, "pieces": pieces, "files": files}}
+
+@pytest.mark.parametrize('workers, batch_size', [(1, 1), (3, 32)])
+def test_verify(tmpdir, workers, batch_size):
+    meta = make_content(tmpdir, [10, 0, 30, 16, 5])
+    progress = []
+    result = metafile.verify(meta, tmpdir.join("data").strpath, workers=workers,
+                             batch_size=batch_size, progress=lambda *args: progress.append(args))
+
+    assert result.complete and result.missing == 0
+    assert list(result.good) == [1] * 4
+    assert result.files() == [1.0] * 5
+    assert progress[-1] == (4, 4)
+
+def test_verify_damaged(tmpdir):
+    meta = make_content(tmpdir, [10, 30, 16, 5, 20])
+    with open(tmpdir.join("data", "f1").strpath, "r+b") as handle:
+        handle.write(b"x")
+    tmpdir.join("data", "f4").remove()
+    result = metafile.verify(meta, tmpdir.join("data").strpath, workers=2, batch_size=16)
+
+    assert not result.complete
+    assert list(result.good) == [0, 1, 1, 0, 0, 0]
+    assert result.files() == [0.0, 2 / 3.0, 0.5, 0.0, 0.0]
+
+def test_verify_single(tmpdir):
+    tmpdir.join("single.bin").write_binary(b"foobar")
+    meta = {"info": {"name": "single.bin", "piece length": 4, "length": 6,
+                     "pieces": hashlib.sha1(b"foob").digest() + hashlib.sha1(b"ar").digest()}}
+
+    assert metafile.verify(meta, tmpdir.join("single.bin").strpath).complete
+    assert not metafile.verify(meta, tmpdir.join("missing.bin").strpath).good[0]
+
+
+def merkle_root(data):
+    layer = [hashlib.sha256(data[i:i + 16384]).digest() for i in range(0, len(data), 16384)]
+    while len(layer) & (len(layer) - 1):
+        layer.append(b"\0" * 32)
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0]
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_make_metafile(tmpdir, workers):
+    make_content(tmpdir, [100, 0, 3000, 1024, 5])
+    torrent = tmpdir.join("data.torrent").strpath
+    meta = metafile.create_metafile(torrent, tmpdir.join("data").strpath, announce="http://example.com/",
+                                    piece_length=1024, workers=workers, batch_size=2048)
+    result = metafile.verify(metafile.load_compact(torrent), tmpdir.join("data").strpath)
+
+    assert meta["announce"] == "http://example.com/"
+    assert [i["path"] for i in meta["info"]["files"]] == [["f%d" % i] for i in range(5)]
+    assert len(meta["info"]["pieces"]) == 20 * 5
+    assert result.complete
+
+def test_make_metafile_single(tmpdir):
+    tmpdir.join("single.bin").write_binary(b"x" * 100000)
+    meta = metafile.make_metafile(tmpdir.join("single.bin").strpath, private=True)
+
+    assert meta["info"]["length"] == 100000
+    assert meta["info"]["piece length"] == 32768
+    assert meta["info"]["private"] == 1
+    assert metafile.verify(meta, tmpdir.join("single.bin").strpath).complete
+
+def test_make_metafile_hybrid(tmpdir):
+    make_content(tmpdir, [100, 40000, 0, 70000])
+    content = [tmpdir.join("data", "f%d" % i).read_binary() for i in range(4)]
+    meta = metafile.make_metafile(tmpdir.join("data").strpath, piece_length=32768, v2=True, workers=2)
+    info, tree = meta["info"], meta["info"]["file tree"]
+
+    assert info["meta version"] == 2
+    assert tree["f0"] == {"": {"length": 100, "pieces root": hashlib.sha256(content[0]).digest()}}
+    assert tree["f1"][""]["pieces root"] == merkle_root(content[1])
+    assert tree["f2"] == {"": {"length": 0}}
+    assert tree["f3"][""]["pieces root"] == merkle_root(content[3])
+    assert sorted(meta["piece layers"]) == sorted([merkle_root(content[1]), merkle_root(content[3])])
+    assert [i["length"] for i in info["files"]] == [100, 32668, 40000, 25536, 0, 70000]
+    assert info["files"][1] == {"attr": "p", "length": 32668, "path": [".pad", "32668"]}
+    assert metafile.verify(meta, tmpdir.join("data").strpath).complete
+
+def test_make_metafile_errors(tmpdir):
+    tmpdir.join("x").write_binary(b"x")
+    with pytest.raises(ValueError):
+        metafile.make_metafile(tmpdir.join("x").strpath, piece_length=1000)
+    with pytest.raises(ValueError):
+        metafile.make_metafile(tmpdir.join("x").strpath, piece_length=8192, v2=True)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -21,9 +21,11 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 from __future__ import absolute_import, print_function, unicode_literals
 
+import sys
 import time
 import socket
 import unittest
+import threading
 
 try:
     from urllib.error import URLError
@@ -32,6 +34,7 @@ except ImportError:
 
 import six
 import pytest
+from six.moves import xmlrpc_client
 
 from pyrobase.io import xmlrpc2scgi
 
@@ -57,6 +60,88 @@ class MockedTransport(object):
         )
 
 
+class MulticallTransport(object):
+    """Transport mock that executes "system.multicall" requests."""
+
+    def __init__(self, failures=0):
+        self.requests = []
+        self.failures = failures
+
+    def send(self, data):
+        xmlreq = data.split(b",", 1)[1].decode('utf-8')
+        params, methodname = xmlrpc_client.loads(xmlreq)
+        assert methodname == "system.multicall"
+        if self.requests and self.failures:
+            self.failures -= 1
+            raise socket.error("Connection reset")
+        self.requests.append(len(params[0]))
+
+        results = []
+        for call in params[0]:
+            if call["methodName"] == "fail":
+                results.append({"faultCode": -501, "faultString": "Failed: %s" % call["params"]})
+            else:
+                results.append([[call["methodName"]] + call["params"]])
+        xml = xmlrpc_client.dumps((results,), methodresponse=True).encode('utf-8')
+        return (b'Content-Length: %d\r\n\r\n' % len(xml), xml)
+
+
+def handle_request(methodname, params):
+    if methodname == "system.multicall":
+        return [[handle_request(i["methodName"], i["params"])] if i["methodName"] != "fail"
+                else {"faultCode": -501, "faultString": "Failed"} for i in params[0]]
+    return [methodname] + list(params)
+
+
+class ScgiServer(object):
+    """Threaded SCGI server that answers with the method name and params."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(50)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                break
+            self.connections += 1
+            try:
+                data = b""
+                while b":" not in data or len(data) < self.request_size(data):
+                    data += conn.recv(65536)
+                xmlreq = data[data.index(b",") + 1:].decode("utf-8")
+                params, methodname = xmlrpc_client.loads(xmlreq)
+                xml = xmlrpc_client.dumps((handle_request(methodname, params),), methodresponse=True)
+                xml = xml.encode("utf-8")
+                conn.sendall(b"Content-Length: %d\r\n\r\n%s" % (len(xml), xml))
+            finally:
+                conn.close()
+
+    @staticmethod
+    def request_size(data):
+        size, rest = data.split(b":", 1)
+        headers = rest[:int(size)].split(b"\0")
+        return len(size) + 2 + int(size) + int(headers[headers.index(b"CONTENT_LENGTH") + 1])
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def server(tmpdir):
+    result = ScgiServer(tmpdir.join("scgi.sock").strpath)
+    yield result
+    result.close()
+
+
 def test_bad_url():
     with pytest.raises(URLError):
         xmlrpc2scgi.transport_from_url("xxxx:///")
@@ -146,6 +231,74 @@ def test_bad_response():
         xmlrpc2scgi._parse_response(bad_data)
 
 
+class ChunkedSocket(object):
+    """Socket that receives its response in small pieces, and accepts partial sends."""
+
+    def __init__(self, response, chunk=7, sendmsg=True):
+        self.response = response
+        self.chunk = chunk
+        self.sent = b""
+        self.calls = 0
+        if sendmsg:
+            self.sendmsg = self._sendmsg
+
+    def _sendmsg(self, buffers):
+        self.calls += 1
+        data = b"".join(i.tobytes() for i in buffers)[:self.chunk]
+        self.sent += data
+        return len(data)
+
+    def sendall(self, data):
+        self.calls += 1
+        self.sent += bytes(data)
+
+    def recv(self, size):
+        data, self.response = self.response[:min(size, self.chunk)], self.response[min(size, self.chunk):]
+        return data
+
+    def recv_into(self, view):
+        data = self.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+@pytest.mark.parametrize('sendmsg', [True, False])
+def test_sendall(sendmsg):
+    sock = ChunkedSocket(b"", sendmsg=sendmsg)
+    xmlrpc2scgi._sendall(sock, [b"12:", b"", b"header", b"...", b"body" * 5])
+
+    assert sock.sent == b"12:header..." + b"body" * 5
+
+def test_sendall_many_parts():
+    sock = ChunkedSocket(b"", chunk=10**6)
+    xmlrpc2scgi._sendall(sock, [b"%d," % i for i in range(1200)])
+
+    assert sock.sent == b"".join(b"%d," % i for i in range(1200))
+    assert sock.calls == 3
+
+@pytest.mark.parametrize('chunk', [1, 7, 4096])
+def test_receive(chunk):
+    body = b"*" * 1000
+    payload, headers = xmlrpc2scgi._receive(ChunkedSocket(b"Content-Length: 1000\r\n\r\n" + body, chunk), 4096)
+
+    assert payload == body and isinstance(payload, bytearray)
+    assert headers == {"Content-Length": "1000"}
+
+def test_receive_without_length():
+    payload, headers = xmlrpc2scgi._receive(ChunkedSocket(b"Status: 200 OK\r\n\r\nfoo bar"), 4096)
+
+    assert payload == b"foo bar"
+    assert headers == {"Status": "200 OK"}
+
+@pytest.mark.parametrize('response', [
+    b"Content-Length: 10\n\n" + b"*" * 10,
+    b"Content-Length: 10\r\n\r\n" + b"*" * 9,
+    b"Content-Length: 10\r\n\r\n" + b"*" * 11,
+])
+def test_bad_receive(response):
+    with pytest.raises(xmlrpc2scgi.SCGIException):
+        xmlrpc2scgi._receive(ChunkedSocket(response, 4096), 4096)
+
+
 def test_scgi_request_init():
     req1 = xmlrpc2scgi.SCGIRequest("example.com:5000")
     req2 = xmlrpc2scgi.SCGIRequest(req1.transport)
@@ -177,6 +330,175 @@ def test_scgi_request_raw():
     assert resp.startswith("<?xml version="), badmsg
     assert "<![CDATA[" in resp, badmsg
 
+def test_scgi_request_large(server):
+    data = "x" * (3 * 1024**2)
+    req = xmlrpc2scgi.SCGIRequest(server.path)
+    resp = req.send([b"<?xml version='1.0'?>", xmlrpc_client.dumps((data,), "d.name").encode()[21:]])
+
+    assert req.resp_headers["Content-Length"] == str(len(resp))
+    assert isinstance(resp, bytes)
+    assert xmlrpc_client.loads(resp)[0][0] == ["d.name", data]
+
+@pytest.mark.parametrize('wrap', [bytes, bytearray, memoryview, lambda x: (x[:10], x[10:])])
+def test_scgi_send_types(server, wrap):
+    data = xmlrpc_client.dumps(("hash",), "d.name").encode()
+    resp = xmlrpc2scgi.SCGIRequest(server.path).send(wrap(data))
+
+    assert xmlrpc_client.loads(resp)[0][0] == ["d.name", "hash"]
+
+def test_scgi_send_buffer(server):
+    req = xmlrpc2scgi.SCGIRequest(server.path)
+    resp = req.send_buffer(xmlrpc_client.dumps(("hash",), "d.name").encode())
+
+    assert isinstance(resp, bytearray)
+    assert xmlrpc_client.loads(resp.decode())[0][0] == ["d.name", "hash"]
+
+
+def test_multicall_batch():
+    transport = MulticallTransport()
+    batch = xmlrpc2scgi.MulticallBatch(transport)
+    indexes = [batch.add("d.stop", "hash%d" % i, i) for i in range(5)]
+    batch.add("fail", "x")
+    results = batch.run()
+
+    assert indexes == list(range(5))
+    assert transport.requests == [6]
+    assert results[:5] == [["d.stop", "hash%d" % i, i] for i in range(5)]
+    assert isinstance(results[5], xmlrpc_client.Fault)
+    assert results[5].faultCode == -501
+    assert len(batch) == 0 and batch.requests == 1
+
+@pytest.mark.parametrize('kwargs, expected', [
+    (dict(max_calls=3), [3, 3, 3, 1]),
+    (dict(max_calls=4), [4, 4, 2]),
+    (dict(max_bytes=700), [2, 2, 2, 2, 2]),
+    (dict(max_bytes=1), [1] * 10),
+])
+def test_multicall_batch_split(kwargs, expected):
+    transport = MulticallTransport()
+    batch = xmlrpc2scgi.MulticallBatch(transport, **kwargs)
+    for i in range(10):
+        batch.add("d.name", "hash%d" % i)
+
+    assert batch.run() == [["d.name", "hash%d" % i] for i in range(10)]
+    assert transport.requests == expected
+
+def test_multicall_batch_retry():
+    transport = MulticallTransport(failures=1)
+    batch = xmlrpc2scgi.MulticallBatch(transport, max_calls=3)
+    for i in range(10):
+        batch.add("d.name", i)
+
+    with pytest.raises(socket.error):
+        batch.run()
+    assert len(batch) == 10 and transport.requests == [3]
+
+    assert batch.run() == [["d.name", i] for i in range(10)]
+    assert transport.requests == [3, 3, 3, 1]
+    assert len(batch) == 0
+
+def test_multicall_batch_raise():
+    batch = xmlrpc2scgi.MulticallBatch(MulticallTransport())
+    batch.add("fail", 1)
+    batch.add("d.name", 2)
+
+    with pytest.raises(xmlrpc_client.Fault):
+        batch.run(raise_faults=True)
+    assert batch.run() == []
+
+
+class EchoTransport(object):
+    """Transport mock that returns the call, after a delay."""
+
+    def __init__(self, delay=.02):
+        self.delay = delay
+        self.inflight = self.max_inflight = 0
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            params, methodname = xmlrpc_client.loads(data.split(b",", 1)[1].decode('utf-8'))
+            time.sleep(self.delay)
+            if methodname == "fail":
+                xml = xmlrpc_client.dumps(xmlrpc_client.Fault(-501, "Failed"), methodresponse=True)
+            else:
+                xml = xmlrpc_client.dumps(([methodname] + list(params),), methodresponse=True)
+            xml = xml.encode('utf-8')
+            return (b'Content-Length: %d\r\n\r\n' % len(xml), xml)
+        finally:
+            with self.lock:
+                self.inflight -= 1
+
+
+def test_scgi_pool_map():
+    transport = EchoTransport()
+    with xmlrpc2scgi.ScgiPool(transport, max_inflight=4) as pool:
+        start = time.time()
+        results = list(pool.map("d.name", [("hash%d" % i, i) for i in range(20)]))
+        elapsed = time.time() - start
+
+    assert results == [["d.name", "hash%d" % i, i] for i in range(20)]
+    assert transport.max_inflight == 4
+    assert len(pool.latencies) == 20 and min(pool.latencies) >= .02
+    assert elapsed < 20 * .02 / 2, "calls must run concurrently"
+
+def test_scgi_pool_faults():
+    with xmlrpc2scgi.ScgiPool(EchoTransport(0), max_inflight=2) as pool:
+        assert list(pool.map("d.name", range(3))) == [["d.name", i] for i in range(3)]
+        results = list(pool.map("fail", ["x"]))
+
+    assert isinstance(results[0], xmlrpc_client.Fault)
+    assert len(pool.latencies) == 1
+
+
+@pytest.fixture
+def relay(server):
+    transport = xmlrpc2scgi.transport_from_url("scgi+ssh+relay://localhost" + server.path)
+    # Run the relay locally instead of via SSH
+    transport.cmd = [sys.executable, "-c", xmlrpc2scgi.RELAY_SCRIPT, server.path]
+    yield transport
+    transport.close()
+
+def test_ssh_relay_transport():
+    transport = xmlrpc2scgi.transport_from_url("scgi+ssh+relay://user@example.com:22/~/rtorrent.sock")
+
+    assert isinstance(transport, xmlrpc2scgi.SSHRelayTransport)
+    assert xmlrpc2scgi.transport_from_url("scgi+ssh+relay://user@example.com:22/~/rtorrent.sock") is transport
+    assert transport.cmd[:7] == ["ssh", "-o", "ServerAliveInterval=30", "-T", "-p", "22", "--"]
+    assert transport.cmd[-4:-2] == ["python3", "-c"] and transport.cmd[-1] == "~/rtorrent.sock"
+
+def test_ssh_relay_requests(relay, server):
+    results = [xmlrpc2scgi.scgi_request(relay, "d.name", i) for i in range(5)]
+    pid = relay.proc.pid
+    results.append(xmlrpc2scgi.scgi_request(relay, "d.name", "x" * 100000))
+
+    assert results[:5] == [["d.name", i] for i in range(5)]
+    assert results[5] == ["d.name", "x" * 100000]
+    assert relay.proc.pid == pid, "session must be reused"
+    assert server.connections == 6
+
+def test_ssh_relay_reconnect(relay):
+    assert xmlrpc2scgi.scgi_request(relay, "d.name", 1) == ["d.name", 1]
+    relay.proc.kill()
+    relay.proc.wait()
+
+    assert xmlrpc2scgi.scgi_request(relay, "d.name", 2) == ["d.name", 2]
+
+def test_ssh_relay_errors(relay, server):
+    server.close()
+    relay.cmd[-1] += ".missing"
+    with pytest.raises(socket.error):
+        xmlrpc2scgi.scgi_request(relay, "d.name")
+
+    relay.close()
+    relay.cmd = [sys.executable, "-c", "import sys; sys.stderr.write('Permission denied'); sys.exit(3)"]
+    with pytest.raises(URLError) as exc:
+        xmlrpc2scgi.scgi_request(relay, "d.name")
+    assert "RC=3" in str(exc.value) and "Permission denied" in str(exc.value)
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,94 @@
+# pylint: disable=missing-docstring, too-few-public-methods
+# pylint: disable=protected-access
+""" Asynchronous SCGI tests.
+
+    Copyright (c) 2011-2020 The PyroScope Project <pyroscope.project@gmail.com>
+"""
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+from __future__ import absolute_import, print_function, unicode_literals
+
+import socket
+
+import six
+import pytest
+from six.moves import xmlrpc_client
+
+from .test_xmlrpc2scgi import server  # pylint: disable=unused-import
+
+if six.PY2:
+    pytest.skip("asyncio needs Python 3", allow_module_level=True)
+
+import asyncio  # pylint: disable=wrong-import-position,wrong-import-order
+from pyrobase.io import xmlrpc2scgi_async  # pylint: disable=wrong-import-position
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro() if callable(coro) else coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_transport_from_url():
+    assert isinstance(xmlrpc2scgi_async.transport_from_url("/tmp/socket"),
+                      xmlrpc2scgi_async.AsyncLocalTransport)
+    assert isinstance(xmlrpc2scgi_async.transport_from_url("scgi+ssh://localhost/tmp/foo"),
+                      xmlrpc2scgi_async.AsyncSSHTransport)
+
+def test_transport_no_blocking_lookup():
+    transport = xmlrpc2scgi_async.transport_from_url("scgi://rtorrent.invalid:5000/")
+
+    assert transport.sock_addr == ("rtorrent.invalid", 5000)
+    assert not hasattr(transport, "request")
+    with pytest.raises(socket.error):
+        run(transport.send(b"0:,"))
+
+def test_scgi_request(server):
+    result = run(xmlrpc2scgi_async.scgi_request(server.path, "d.name", "hash", 42))
+    assert result == ["d.name", "hash", 42]
+
+def test_scgi_request_raw(server):
+    result = run(xmlrpc2scgi_async.scgi_request(server.path, "d.name", deserialize=False))
+    assert result.startswith("<?xml") and "<string>d.name</string>" in result
+
+def test_scgi_request_concurrent(server):
+    results = run(lambda: asyncio.gather(*[
+        xmlrpc2scgi_async.scgi_request(server.path, "d.name", i) for i in range(50)
+    ]))
+
+    assert results == [["d.name", i] for i in range(50)]
+    assert server.connections == 50
+
+def test_scgi_request_refused(tmpdir):
+    with pytest.raises(socket.error):
+        run(xmlrpc2scgi_async.scgi_request(tmpdir.join("nope.sock").strpath, "d.name"))
+
+def test_async_multicall_batch(server):
+    batch = xmlrpc2scgi_async.AsyncMulticallBatch(server.path, max_calls=4)
+    for i in range(10):
+        batch.add("d.name" if i != 5 else "fail", i)
+    results = run(batch.run())
+
+    assert batch.requests == 3 and server.connections == 3
+    assert results[:5] == [["d.name", i] for i in range(5)]
+    assert isinstance(results[5], xmlrpc_client.Fault)
+    assert results[6:] == [["d.name", i] for i in range(6, 10)]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])